@@ -0,0 +1,247 @@
+''' Benchmark of the wit commands on synthetic repositories.
+Every command runs in a fresh interpreter, so the peak memory (max RSS) is that of a process which ran
+the one command and nothing else. The child times wit.main itself, the timing leaves out the interpreter
+start and the import of wit.
+
+    python benchmark.py --files 20000 --history 20 --output new.json
+    python benchmark.py --files 20000 --history 20 --compare old.json --threshold 0.1
+'''
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+import wit
+
+
+# commands timed by every run, in order
+COMMANDS = ('init', 'add', 'commit', 'branch', 'status', 'status_dirty', 'checkout', 'merge', 'graph')
+# run by the child interpreter: python -c CHILD_CODE <wit folder> <result fd> <wit arguments>
+# wit logs a failed command and returns, the logged errors go back with the seconds
+CHILD_CODE = '''
+import json, logging, os, sys, time
+sys.path.insert(0, sys.argv[1])
+import wit
+errors = logging.Handler(logging.ERROR)
+errors.records = []
+errors.emit = errors.records.append
+logging.getLogger().addHandler(errors)
+start = time.perf_counter()
+wit.main(sys.argv[3:])
+seconds = time.perf_counter() - start
+sys.stdout.flush()
+os.write(int(sys.argv[2]), json.dumps({
+    'seconds': seconds, 'errors': [record.getMessage() for record in errors.records]}).encode())
+'''
+
+
+def run_command(argv, is_verbose=False):
+    ''' Run one wit command in a fresh interpreter, in the current directory.
+    Raises: RuntimeError if the command failed or logged an error, so a no-op is never timed
+    Return: (seconds of wit.main, max RSS KiB of the child)
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if not is_verbose:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, sys.stdout.fileno())
+                os.dup2(devnull, sys.stderr.fileno())
+            os.close(read_fd)
+            os.set_inheritable(write_fd, True)
+            os.execv(sys.executable, [sys.executable, '-c', CHILD_CODE, os.path.dirname(os.path.abspath(wit.__file__)),
+                                      str(write_fd)] + argv)
+        finally:
+            os._exit(1)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as fh:
+        text = fh.read()
+    _, status, usage = os.wait4(pid, 0)
+    if os.WEXITSTATUS(status) != 0 or not text:
+        raise RuntimeError('wit {} failed'.format(' '.join(argv)))
+    result = json.loads(text)
+    if result['errors']:
+        raise RuntimeError('wit {} failed: {}'.format(' '.join(argv), '; '.join(result['errors'])))
+    return result['seconds'], usage.ru_maxrss
+
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        # text like content, so diffs and merges see lines
+        line = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(63)).encode() + b'\n'
+        fh.write((line * (size // len(line) + 1))[:size])
+
+
+def get_file_size(rng, args):
+    # log normal sizes around the median, a few files far bigger than most
+    return min(int(rng.lognormvariate(0, args.size_sigma) * args.file_size), args.max_file_size)
+
+
+def build_files(root, args, rng):
+    ''' Create the working files, spread over folders args.depth levels deep.
+    Return: relative paths of the files
+    '''
+    paths = []
+    for number in range(args.files):
+        folders = ['d{}'.format(rng.randrange(args.fanout)) for _ in range(rng.randint(0, args.depth))]
+        path = os.path.join(*folders, 'f{}.txt'.format(number))
+        write_file(os.path.join(root, path), get_file_size(rng, args), rng)
+        paths.append(path)
+    with open(os.path.join(root, '.witignore'), 'w') as fh:
+        # wit logs to error.log in the working directory
+        fh.write('error.log\n')
+    return paths
+
+
+def change_files(root, paths, count, rng):
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(os.path.join(root, path), 'ab') as fh:
+            fh.write('change {}\n'.format(rng.random()).encode())
+
+
+def run_suite(args, seed):
+    ''' Build a repository and time every command once.
+    Return: {command: {'seconds': wall seconds, 'max_rss_kib': peak memory}}
+    '''
+    rng = random.Random(seed)
+    root = tempfile.mkdtemp(prefix='wit-bench-', dir=args.tmp_dir)
+    old_cwd = os.getcwd()
+    results = {}
+
+    def measure(name, argv):
+        seconds, max_rss = run_command(argv, args.verbose)
+        results[name] = {'seconds': seconds, 'max_rss_kib': max_rss}
+
+    try:
+        paths = build_files(root, args, rng)
+        os.chdir(root)
+        measure('init', ['init'])
+        measure('add', ['add', '.', '--jobs', str(args.jobs)])
+        measure('commit', ['commit', 'initial'])
+        # history, a branch every history / branches commits
+        branch_every = max(1, args.history // max(1, args.branches))
+        for number in range(args.history):
+            change_files(root, paths, args.churn, rng)
+            run_command(['add', '.'], args.verbose)
+            run_command(['commit', 'change {}'.format(number)], args.verbose)
+            if number % branch_every == 0 and number // branch_every < args.branches:
+                run_command(['branch', 'b{}'.format(number // branch_every)], args.verbose)
+        measure('branch', ['branch', 'feature'])
+        measure('status', ['status'])
+        change_files(root, paths, args.churn, rng)
+        measure('status_dirty', ['status'])
+        run_command(['add', '.'], args.verbose)
+        run_command(['commit', 'before checkout'], args.verbose)
+        # the feature branch gets its own changes, then master merges it
+        measure('checkout', ['checkout', 'feature', '--jobs', str(args.jobs)])
+        with open(os.path.join(root, 'feature.txt'), 'w') as fh:
+            fh.write('feature\n')
+        run_command(['add', 'feature.txt'], args.verbose)
+        run_command(['commit', 'feature work'], args.verbose)
+        run_command(['checkout', 'master'], args.verbose)
+        measure('merge', ['merge', 'feature'])
+        measure('graph', ['graph', '--text', '--all'])
+    finally:
+        os.chdir(old_cwd)
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def get_revision():
+    # git revision of wit.py, None outside a git checkout
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(wit.__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs):
+    # median over the runs of every measured value
+    return {command: {key: statistics.median(run[command][key] for run in runs) for key in runs[0][command]}
+            for command in COMMANDS}
+
+
+def compare(results, baseline, threshold):
+    ''' Print every command against the baseline.
+    Return: commands slower than the baseline by more than threshold (a fraction)
+    '''
+    regressions = []
+    print('{:<14}{:>12}{:>12}{:>9}{:>12}'.format('command', 'baseline s', 'current s', 'change', 'max RSS KiB'))
+    for command in COMMANDS:
+        current = results[command]['seconds']
+        old = baseline['results'].get(command, {}).get('seconds')
+        if not old:
+            print('{:<14}{:>12}{:>12.4f}{:>9}{:>12}'.format(command, '-', current, '-', results[command]['max_rss_kib']))
+            continue
+        change = current / old - 1
+        print('{:<14}{:>12.4f}{:>12.4f}{:>8.1%}{:>12}'.format(command, old, current, change, results[command]['max_rss_kib']))
+        if change > threshold:
+            regressions.append(command)
+    return regressions
+
+
+def parse_input(argv):
+    parser = argparse.ArgumentParser(description="Time wit commands on a synthetic repository.")
+    parser.add_argument("--files", type=int, default=1000, help="number of files.")
+    parser.add_argument("--file-size", type=int, default=4096, help="median file size in bytes.")
+    parser.add_argument("--size-sigma", type=float, default=1.0, help="spread of the log normal file sizes.")
+    parser.add_argument("--max-file-size", type=int, default=64 * 1024 * 1024, help="largest file size in bytes.")
+    parser.add_argument("--depth", type=int, default=3, help="deepest folder level of a file.")
+    parser.add_argument("--fanout", type=int, default=8, help="sub folders of a folder.")
+    parser.add_argument("--history", type=int, default=10, help="commits made before the timed commands.")
+    parser.add_argument("--churn", type=int, default=10, help="files changed by every commit.")
+    parser.add_argument("--branches", type=int, default=3, help="branches created during the history.")
+    parser.add_argument("--runs", type=int, default=3, help="repositories to build, the median run is reported.")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, the same seed builds the same files.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="--jobs of add and checkout.")
+    parser.add_argument("--tmp-dir", help="folder to build the repositories in.")
+    parser.add_argument("--keep", action="store_true", help="keep the repositories.")
+    parser.add_argument("--verbose", action="store_true", help="show the wit output.")
+    parser.add_argument("--output", help="JSON file to write, standard output if missing.")
+    parser.add_argument("--compare", metavar="JSON", help="results of an earlier run to compare with.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fraction slower than --compare which counts as a regression.")
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_input(argv)
+    runs = [run_suite(args, args.seed + number) for number in range(args.runs)]
+    report = {
+        'revision': get_revision(),
+        'date': datetime.now().astimezone().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {name: value for name, value in vars(args).items()
+                       if name not in ('output', 'compare', 'threshold', 'keep', 'verbose', 'tmp_dir')},
+        'results': summarize(runs),
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(text + '\n')
+    elif not args.compare:
+        print(text)
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(report['results'], json.load(fh), args.threshold)
+        if regressions:
+            print('Slower than {:.0%} over the baseline: {}'.format(args.threshold, ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,22 +1,180 @@
 import argparse
+from array import array
+import atexit
+from collections import Counter
 from collections import defaultdict
+from collections import namedtuple
+from contextlib import contextmanager
+from contextlib import nullcontext
 from datetime import datetime
-from distutils.dir_util import copy_tree
-from filecmp import dircmp
+from fnmatch import fnmatchcase
+from functools import lru_cache
 from functools import partial
 from functools import wraps
+import hashlib
+import importlib
+import io
+import heapq
+from itertools import chain
+from itertools import islice
 import logging
+import mmap
 import os
-from pathlib import Path
-import random
+import re
 import shutil
 import string
+import struct
 import sys
+import tempfile
+import time
+from types import SimpleNamespace
 from typing import List
+import zlib
 
-from dateutil.tz import tzlocal
-from graphviz import Digraph
-from termcolor import colored
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# seconds spent on modules imported on first use, see lazy_import
+LAZY_IMPORT_TIMES = {}
+
+
+def lazy_import(module_name):
+    ''' Import a module the first time a command needs it, the others never pay for it.
+    Return: the module
+    '''
+    module = sys.modules.get(module_name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        LAZY_IMPORT_TIMES[module_name] = time.perf_counter() - start
+    return module
+
+
+def colored(text, color=None, attrs=None):
+    return lazy_import('termcolor').colored(text, color, attrs=attrs)
+
+
+# the Tracer of this process, None when tracing is off - see main
+TRACER = None
+TRACE_FILE = 'wit-trace.json'
+NO_SPAN = nullcontext()
+
+
+class Tracer:
+    ''' Nested spans of a command, each with its wall time and counters - files_opened,
+    files_stat and bytes_copied. Counters of a span include those of the spans inside it.
+    Opened files are counted by an audit hook and os.stat/os.lstat calls by wrappers,
+    both installed only when tracing is on.
+    '''
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.events = []
+        # open spans: (name path, start time, counters)
+        self.stack = []
+        # name path: [calls, seconds, counters]
+        self.totals = {}
+        self.lock = lazy_import('threading').Lock()
+        # not counted, for the tracer's own use
+        self.stat = os.stat
+
+    def install(self):
+        sys.addaudithook(self.audit)
+        os.stat = self.counted(os.stat, 'files_stat')
+        os.lstat = self.counted(os.lstat, 'files_stat')
+
+    def counted(self, function, counter):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            self.count(counter)
+            return function(*args, **kwargs)
+        return wrapper
+
+    def audit(self, event, args):
+        if event == 'open' and isinstance(args[0], (str, bytes)):
+            self.count('files_opened')
+
+    def count(self, counter, value=1):
+        # counted on the innermost span, worker threads count on the span which started them
+        with self.lock:
+            if self.stack:
+                counters = self.stack[-1][2]
+                counters[counter] = counters.get(counter, 0) + value
+
+    @contextmanager
+    def span(self, name):
+        path = (self.stack[-1][0] if self.stack else ()) + (name,)
+        # the summary lists spans in the order they first started
+        self.totals.setdefault(path, [0, 0, {}])
+        self.stack.append((path, time.perf_counter(), {}))
+        try:
+            yield
+        finally:
+            with self.lock:
+                _, start, counters = self.stack.pop()
+                if self.stack:
+                    parent_counters = self.stack[-1][2]
+                    for counter, value in counters.items():
+                        parent_counters[counter] = parent_counters.get(counter, 0) + value
+            seconds = time.perf_counter() - start
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                                'ts': (start - self.start) * 1e6, 'dur': seconds * 1e6, 'args': counters})
+            calls, total, total_counters = self.totals[path]
+            self.totals[path][:2] = calls + 1, total + seconds
+            for counter, value in counters.items():
+                total_counters[counter] = total_counters.get(counter, 0) + value
+
+    def write(self, trace_file):
+        # Chrome trace event format, opened by chrome://tracing or ui.perfetto.dev
+        with open(trace_file, 'w') as fh:
+            lazy_import('json').dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, fh)
+
+    def format_summary(self):
+        lines = ['{:<40}{:>7}{:>11}{:>8}{:>8}{:>13}'.format(
+            'span', 'calls', 'total ms', 'opened', 'stat', 'bytes copied')]
+        for path, (calls, seconds, counters) in self.totals.items():
+            lines.append('{:<40}{:>7}{:>11.2f}{:>8}{:>8}{:>13}'.format(
+                '  ' * (len(path) - 1) + path[-1], calls, seconds * 1000, counters.get('files_opened', 0),
+                counters.get('files_stat', 0), counters.get('bytes_copied', 0)))
+        return '\n'.join(lines) + '\n'
+
+
+def trace_span(name):
+    # context manager of a span, shared and empty when tracing is off
+    return NO_SPAN if TRACER is None else TRACER.span(name)
+
+
+def traced(name):
+    ''' Decorator - every call of the function is a span '''
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if TRACER is None:
+                return function(*args, **kwargs)
+            with TRACER.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_count(counter, value=1):
+    if TRACER is not None:
+        TRACER.count(counter, value)
+
+
+def trace_bytes(path):
+    # count a written file as bytes_copied
+    if TRACER is not None:
+        TRACER.count('bytes_copied', TRACER.stat(path).st_size)
+
+
+def start_tracing():
+    global TRACER
+    TRACER = Tracer()
+    TRACER.install()
 
 
 class Commends:
@@ -29,6 +187,14 @@ class Commends:
     GRAPH = 'graph'
     BRANCH = 'branch'
     MERGE = 'merge'
+    CONFIG = 'config'
+    DIFF = 'diff'
+    GC = 'gc'
+    DAEMON = 'daemon'
+    LOG = 'log'
+    REPACK = 'repack'
+    SPARSE = 'sparse'
+    BLAME = 'blame'
 
     def __init__(self) -> None:
         self.INIT
@@ -40,6 +206,27 @@ class Commends:
         self.GRAPH
         self.BRANCH
         self.MERGE
+        self.CONFIG
+        self.DIFF
+        self.GC
+        self.DAEMON
+        self.LOG
+        self.REPACK
+        self.SPARSE
+        self.BLAME
+
+
+class Changes:
+    NEW = 'new file'
+    MODIFIED = 'modified file'
+    DELETED = 'deleted file'
+    UNTRACKED = 'untracked'
+
+    def __init__(self) -> None:
+        self.NEW
+        self.MODIFIED
+        self.DELETED
+        self.UNTRACKED
 
 
 class WitException(Exception):
@@ -47,568 +234,3730 @@ class WitException(Exception):
         logging.error(message)
 
 
-class WitRepo:
-    def __init__(self, wit_root_path) -> None:
-        self.wit_root_path = wit_root_path
-        self.wit_dir = os.path.join(self.wit_root_path, '.wit')
-        self.wit_images_dir = os.path.join(self.wit_dir, 'images')
-        self.wit_staging_dir = os.path.join(self.wit_dir, 'staging_area')
-        self.wit_references_file = os.path.join(self.wit_dir, 'references.txt')
-        self.wit_active_branch_file = os.path.join(
-            self.wit_dir, 'activated.txt')
-        self.branches = {}
-        self.commit_history = defaultdict(list)
+CHUNK_SIZE = 1024 * 1024
+FILE_MODE = '100644'
+EXECUTABLE_MODE = '100755'
+TREE_MODE = '040000'
+DIFF_CONTEXT = 3
+# lines of equal hash compared byte by byte at once
+LINE_BLOCK = 4096
+# added and deleted files are paired as a rename from this percent of similar lines
+RENAME_SIMILARITY = 50
+RENAME_LIMIT = 1000
+DATE_FORMAT = "%a %b %d %H:%M:%S %Y %z"
+# shortest abbreviated commit id accepted
+MIN_ABBREV = 4
+# gitignore style rules of a folder and the folders under it
+IGNORE_FILE = '.witignore'
+# how files are copied between working directory and object store, first is the default:
+# reflink - share disk blocks (FICLONE, copy_file_range) when the file system supports it, else copy
+# copy - plain read and write
+LINK_MODES = ('reflink', 'copy')
+FICLONE = 0x40049409
+# packed objects - deltas match blocks of DELTA_BLOCK bytes, and are chained at most MAX_DELTA_DEPTH deep
+DELTA_BLOCK = 16
+DELTA_COPY = struct.Struct('>BII')
+DELTA_INSERT = struct.Struct('>BI')
+MAX_DELTA_DEPTH = 50
+DELTA_SIZE_LIMIT = 64 * CHUNK_SIZE
+DELTA_CACHE_SIZE = 64
+# large files - stored as a list of content defined chunks from LARGE_FILE_SIZE, see iter_chunk_bounds.
+# A chunk ends where the crc32 of the window of bytes before it is 0 under the mask.
+LARGE_FILE_SIZE = 16 * CHUNK_SIZE
+CHUNKED_HEADER = b'wit chunked file\n'
+CDC_MIN_SIZE = 64 * 1024
+CDC_MAX_SIZE = CHUNK_SIZE
+CDC_WINDOW = 32
+CDC_MASK = 0x3ff
+# references - seconds to wait for another wit process to release them, branches kept unpacked
+REFS_LOCK_TIMEOUT = 10
+LOOSE_REFS_LIMIT = 64
+# graph - nodes above which graphviz layout gets slow
+GRAPH_NODES_WARNING = 500
+# changed path filters - bits per changed path, bits set per path, changed paths above which a filter matches every path
+PATH_FILTER_BITS = 10
+PATH_FILTER_HASHES = 7
+PATH_FILTER_LIMIT = 512
+# daemon - socket file in .wit, seconds a client waits for a reply before working without it
+DAEMON_SOCKET = 'daemon.sock'
+DAEMON_TIMEOUT = 2
+# inotify(7) event masks
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
 
-    def __str__(self) -> str:
-        return 'root path: {}\nwit dir: {}\nref file: {}'.format(self.wit_root_path, self.wit_dir, self.wit_references_file)
 
-    def update_wit_dir(self, new_root):
-        self.wit_root_path = new_root
-        self.wit_dir = os.path.join(self.wit_root_path, '.wit')
-        self.wit_images_dir = os.path.join(self.wit_dir, 'images')
-        self.wit_staging_dir = os.path.join(self.wit_dir, 'staging_area')
-        self.wit_references_file = os.path.join(self.wit_dir, 'references.txt')
-        self.wit_active_branch_file = os.path.join(
-            self.wit_dir, 'activated.txt')
+def hash_file(path):
+    # a large file is identified by its chunk list, see get_file_chunks
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        chunks = get_file_chunks(fh)
+        if chunks is not None:
+            return hashlib.sha1(format_chunk_list(chunks)).hexdigest()
+        for chunk in iter(partial(fh.read, CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
-    def validate_repo_at_path(self, path, is_path_required):
-        self.wit_dir = self.find_repo(path, is_path_required)
-        if self.wit_dir is None:
-            raise WitException(
-                'Not a wit repository (or any of the parent directories): {}'.format('.wit'))
-        self.update_wit_dir(Path(self.wit_dir).parent)
-        return self.wit_dir
 
-    def find_repo(self, path='.', required=False):
-        path = os.path.realpath(path)
-        if os.path.isdir(os.path.join(path, '.wit')):
-            if required:
-                return os.path.join(path, '.wit')
-            return True
-        parent = os.path.realpath(os.path.join(path, ".."))
-        if parent == path:
-            if required:
+def iter_chunk_bounds(data):
+    ''' Content defined chunks - a boundary depends only on the bytes just before it,
+    so an edit changes the chunks around it and the following chunks are found again.
+    Args: data - bytes or mmap
+    Return: generator of (start, end) offsets
+    '''
+    start = 0
+    with memoryview(data) as view:
+        while start < len(data):
+            end = min(start + CDC_MAX_SIZE, len(data))
+            position = start + CDC_MIN_SIZE
+            while position < end:
+                window = view[position - CDC_WINDOW:position]
+                if zlib.crc32(window) & CDC_MASK == 0:
+                    end = position
+                    break
+                if window[0] == window[-1] and window.tobytes() == bytes(window[:1]) * CDC_WINDOW:
+                    # every window inside a run of one byte value hashes the same, e.g. zeros - skip to its end
+                    position = end - len(data[position:end].lstrip(bytes(window[:1])))
+                position += 1
+            yield start, end
+            start = end
+
+
+def get_file_chunks(fh):
+    ''' Chunks of a file stored as a chunk list - a large file, or a file which starts like a chunk list.
+    Args: fh - file open for binary read at its start, left at its start for a file stored whole
+    Return: [(chunk id, start, end)], None for a file stored whole
+    '''
+    size = os.fstat(fh.fileno()).st_size
+    if size < LARGE_FILE_SIZE:
+        head = fh.read(len(CHUNKED_HEADER))
+        fh.seek(0)
+        if head != CHUNKED_HEADER:
+            return None
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return [(hashlib.sha1(data[start:end]).hexdigest(), start, end) for start, end in iter_chunk_bounds(data)]
+
+
+def format_chunk_list(chunks):
+    return CHUNKED_HEADER + ''.join('{} {}\n'.format(chunk_id, end - start) for chunk_id, start, end in chunks).encode()
+
+
+def parse_chunk_list(data):
+    # [(chunk id, size)] of a chunk list object
+    return [(chunk_id, int(size)) for chunk_id, size in (
+        line.split(' ') for line in data[len(CHUNKED_HEADER):].decode().splitlines())]
+
+
+def append_file_data(source_fh, target_fh, size):
+    ''' Copy size bytes from the source file position to the target file position.
+    Both files are unbuffered, the copy is done in the kernel by copy_file_range or sendfile when possible.
+    '''
+    source, target = source_fh.fileno(), target_fh.fileno()
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(lambda count: os.copy_file_range(source, target, count))
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(lambda count: os.sendfile(target, source, None, count))
+    for kernel_copy in kernel_copies:
+        try:
+            while size > 0:
+                copied = kernel_copy(size)
+                if copied == 0:
+                    return
+                size -= copied
+            return
+        except OSError:
+            # not supported for these files, the bytes copied so far moved both positions
+            continue
+    while size > 0:
+        data = source_fh.read(min(size, CHUNK_SIZE))
+        if not data:
+            return
+        target_fh.write(data)
+        size -= len(data)
+
+
+def copy_file_data(source_path, target_fh, link_mode=LINK_MODES[0]):
+    ''' Copy file content into an empty, open target file.
+    Tries a reflink clone, then an in kernel copy_file_range, then a plain read and write copy.
+    '''
+    with open(source_path, 'rb') as src:
+        if link_mode == 'reflink':
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(target_fh.fileno(), FICLONE, src.fileno())
+                    return
+                except OSError:
+                    pass
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while os.copy_file_range(src.fileno(), target_fh.fileno(), CHUNK_SIZE * 64):
+                        pass
+                    return
+                except OSError:
+                    # not supported here - start over with a plain copy
+                    os.lseek(src.fileno(), 0, os.SEEK_SET)
+                    os.lseek(target_fh.fileno(), 0, os.SEEK_SET)
+                    os.ftruncate(target_fh.fileno(), 0)
+        shutil.copyfileobj(src, target_fh, CHUNK_SIZE)
+
+
+def run_jobs(function, items, jobs=1):
+    ''' Call function on every item, on a pool of jobs threads when jobs > 1.
+    Return: list of results in items order, same as the serial run
+    '''
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with lazy_import('concurrent.futures').ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, items))
+
+
+def read_umask():
+    # the umask can only be read by setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+# read once on import, while no other thread creates files
+UMASK = read_umask()
+
+
+def make_temp_file(folder, mode=0o666, suffix=''):
+    ''' tempfile.mkstemp with the permissions of a new file instead of 0600, so files renamed
+    into place stay readable by the group of a shared repository.
+    Args: mode - permissions before the umask, 0o444 for objects which never change
+    Return: (fd, path)
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=folder, suffix=suffix)
+    os.fchmod(fd, mode & ~UMASK)
+    return fd, temp_path
+
+
+def get_file_mode(path):
+    if os.access(path, os.X_OK):
+        return EXECUTABLE_MODE
+    return FILE_MODE
+
+
+def split_tree_entry(entry):
+    # (mode, type, id) tree entry -> ((mode, blob id) or None, tree id or None)
+    if entry is None:
+        return None, None
+    mode, object_type, object_id = entry
+    if object_type == 'tree':
+        return None, object_id
+    return (mode, object_id), None
+
+
+def create_delta(base, target, limit):
+    ''' Binary delta of target against base - ranges copied from base and inserted new bytes.
+    Base blocks are hashed, target is scanned for them and every match is extended both ways.
+    Args: limit - give up once the delta grows beyond this size
+    Return: delta bytes, None when it would be larger than limit
+    '''
+    blocks = {}
+    for offset in range(len(base) - DELTA_BLOCK, -1, -DELTA_BLOCK):
+        blocks[base[offset:offset + DELTA_BLOCK]] = offset
+    # probe a few target spots first, so a dissimilar file is given up without scanning it all
+    probes = range(0, len(target) - 2 * DELTA_BLOCK, max(len(target) // 64, DELTA_BLOCK))
+    hits = sum(any(target[probe + shift:probe + shift + DELTA_BLOCK] in blocks for shift in range(
+        DELTA_BLOCK)) for probe in probes)
+    if hits * 4 < len(probes):
+        return None
+    delta = []
+    size = 0
+    insert_start = position = 0
+    while position <= len(target) - DELTA_BLOCK:
+        base_offset = blocks.get(target[position:position + DELTA_BLOCK])
+        if base_offset is None:
+            position += 1
+            if size + position - insert_start > limit:
                 return None
-            return False
-        return self.find_repo(parent, required)
+            continue
+        backward = count_matching_lines(base, target, base_offset, position, min(
+            base_offset, position - insert_start), step=-1)
+        forward = count_matching_lines(base, target, base_offset + DELTA_BLOCK, position + DELTA_BLOCK, min(
+            len(base) - base_offset, len(target) - position) - DELTA_BLOCK)
+        start, end = position - backward, position + DELTA_BLOCK + forward
+        if start > insert_start:
+            delta.append(DELTA_INSERT.pack(1, start - insert_start) + target[insert_start:start])
+            size += DELTA_INSERT.size + start - insert_start
+        delta.append(DELTA_COPY.pack(0, base_offset - backward, end - start))
+        size += DELTA_COPY.size
+        insert_start = position = end
+    if len(target) > insert_start:
+        delta.append(DELTA_INSERT.pack(1, len(target) - insert_start) + target[insert_start:])
+        size += DELTA_INSERT.size + len(target) - insert_start
+    if size > limit:
+        return None
+    return b''.join(delta)
 
-    def get_references_file_data(self):
-        return dict(line.rstrip().split('=') for line in open(self.wit_references_file) if not line.startswith("#"))
 
-    def create_references_file(self, head, master, branches):
-        with open(self.wit_references_file, 'w') as fh:
-            data = "HEAD={}\nmaster={}\n".format(head, master)
-            for branch_name, commit_id in branches.items():
-                data = data + '{}={}\n'.format(branch_name, commit_id)
-            fh.write(data)
+def apply_delta(base, delta):
+    parts = []
+    offset = 0
+    while offset < len(delta):
+        if delta[offset] == 0:
+            _, base_offset, length = DELTA_COPY.unpack_from(delta, offset)
+            parts.append(base[base_offset:base_offset + length])
+            offset += DELTA_COPY.size
+        else:
+            _, length = DELTA_INSERT.unpack_from(delta, offset)
+            offset += DELTA_INSERT.size
+            parts.append(delta[offset:offset + length])
+            offset += length
+    return b''.join(parts)
 
-    def update_references_file(self, commit_id, flow='commit'):
-        head = self.get_current_commit_id()
-        master = self.get_references_file_data().get('master')
-        self.branches = self.get_branches()
-        active_branch = self.get_active_branch()
-        active_branch_commit_id = self.branches.get(active_branch)
-        if head == active_branch_commit_id:
-            # will update 'master' if active branch is 'master'
-            self.branches[active_branch] = commit_id
-        self.branches.pop('master')
-        if flow == 'commit':
-            if head == master and master == active_branch_commit_id:
-                self.create_references_file(
-                    commit_id, commit_id, self.branches)
+
+class IdIndex:
+    ''' Memory mapped file of sorted 20 byte ids, each with a fixed size value.
+    A fanout table like git's - how many ids start with each first byte or less - narrows
+    the binary search of an id or id prefix to one first byte.
+    '''
+    HEADER = b'WITX\x00\x00\x00\x01'
+    COUNT = struct.Struct('>I')
+    FANOUT = struct.Struct('>256I')
+    IDS = len(HEADER) + COUNT.size + FANOUT.size
+
+    def __init__(self, index_file, value_format) -> None:
+        self.index_file = index_file
+        self.value = struct.Struct(value_format)
+        self.data = b''
+        self.count = 0
+        self.fanout = (0,) * 256
+
+    def load(self):
+        self.data = b''
+        self.count = 0
+        self.fanout = (0,) * 256
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as fh:
+                self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = self.COUNT.unpack_from(self.data, len(self.HEADER))[0]
+            self.fanout = self.FANOUT.unpack_from(self.data, len(self.HEADER) + self.COUNT.size)
+        return self
+
+    def write(self, items):
+        ''' Args: items - (raw id, value) pairs '''
+        items = sorted(items)
+        fanout = [0] * 256
+        for raw_id, _ in items:
+            fanout[raw_id[0]] += 1
+        for first_byte in range(1, 256):
+            fanout[first_byte] += fanout[first_byte - 1]
+        fd, temp_path = make_temp_file(os.path.dirname(self.index_file))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(self.HEADER + self.COUNT.pack(len(items)) + self.FANOUT.pack(*fanout))
+            fh.write(b''.join(raw_id for raw_id, _ in items))
+            fh.write(b''.join(self.value.pack(value) for _, value in items))
+        os.replace(temp_path, self.index_file)
+        return self.load()
+
+    def __len__(self):
+        return self.count
+
+    def get_id(self, position):
+        offset = self.IDS + position * 20
+        return self.data[offset:offset + 20]
+
+    def get_value(self, position):
+        return self.value.unpack_from(self.data, self.IDS + self.count * 20 + position * self.value.size)[0]
+
+    def find_prefix(self, prefix, limit=2):
+        ''' Values of the ids starting with a hex prefix, at most limit of them '''
+        low, high = 0, self.count
+        if len(prefix) >= 2:
+            first_byte = int(prefix[:2], 16)
+            low, high = self.fanout[first_byte - 1] if first_byte else 0, self.fanout[first_byte]
+        key = bytes.fromhex(prefix + '0' * (len(prefix) % 2))
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_id(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        matches = []
+        while low < self.count and len(matches) < limit and self.get_id(low).hex().startswith(prefix):
+            matches.append(self.get_value(low))
+            low += 1
+        return matches
+
+
+class Pack:
+    ''' Read only file of zlib compressed objects, .wit/objects/pack/pack-<id>.pack,
+    with a .idx id index of their entry offsets.
+    An entry is its kind, base entry offset, compressed size and compressed content:
+    the object itself, or a delta against the base entry which was written before it.
+    '''
+    HEADER = b'WITP\x00\x00\x00\x01'
+    ENTRY = struct.Struct('>BQI')
+    FULL = 0
+    DELTA = 1
+
+    def __init__(self, pack_file) -> None:
+        self.pack_file = pack_file
+        self.index = IdIndex(pack_file[:-len('.pack')] + '.idx', '>Q').load()
+        with open(pack_file, 'rb') as fh:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        # delta chains share their bases, keep the recently read ones
+        self.read_entry = lru_cache(maxsize=DELTA_CACHE_SIZE)(self.read_entry)
+
+    def find(self, object_id):
+        offsets = self.index.find_prefix(object_id, 1)
+        return offsets[0] if offsets else None
+
+    def iter_ids(self):
+        for position in range(len(self.index)):
+            yield self.index.get_id(position).hex()
+
+    def read_entry(self, offset):
+        kind, base_offset, size = self.ENTRY.unpack_from(self.data, offset)
+        start = offset + self.ENTRY.size
+        content = zlib.decompress(self.data[start:start + size])
+        if kind == self.DELTA:
+            content = apply_delta(self.read_entry(base_offset), content)
+        return content
+
+
+class ObjectStore:
+    ''' Content addressable store of blobs and trees under .wit/objects.
+    Every object is saved once, named by the sha1 of its content.
+    A tree object holds one "<mode> <type> <object id>\t<name>" line per entry.
+    '''
+
+    def __init__(self, objects_dir, jobs=1, link_mode=LINK_MODES[0]) -> None:
+        self.objects_dir = objects_dir
+        self.pack_dir = os.path.join(objects_dir, 'pack')
+        self.jobs = jobs
+        self.link_mode = link_mode
+        self.packs = None
+        # object id: temporary file of get_object_file
+        self.extracted_files = {}
+
+    def get_object_path(self, object_id):
+        return os.path.join(self.objects_dir, object_id[:2], object_id[2:])
+
+    def get_packs(self, is_rescan=False):
+        ''' Args: is_rescan - list the pack folder again, for packs written or removed by another process '''
+        if self.packs is None or is_rescan:
+            loaded = {pack.pack_file: pack for pack in self.packs or []}
+            pack_files = []
+            if os.path.isdir(self.pack_dir):
+                # a pack is complete once its index was written
+                pack_files = [os.path.join(self.pack_dir, name[:-len('.idx')] + '.pack')
+                              for name in sorted(os.listdir(self.pack_dir)) if name.endswith('.idx')]
+            self.packs = [loaded.get(pack_file) or Pack(pack_file) for pack_file in pack_files]
+        return self.packs
+
+    def find_packed(self, object_id):
+        for pack in self.get_packs():
+            offset = pack.find(object_id)
+            if offset is not None:
+                return pack, offset
+        return None, None
+
+    def is_object_exist(self, object_id):
+        return os.path.isfile(self.get_object_path(object_id)) or self.find_packed(object_id)[0] is not None
+
+    def save_object(self, object_id, write_content):
+        # write to a temporary file first so a crash never leaves a partial object
+        object_path = self.get_object_path(object_id)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        fd, temp_path = make_temp_file(os.path.dirname(object_path), 0o444)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                write_content(fh)
+            trace_bytes(temp_path)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def write_data(self, data):
+        object_id = hashlib.sha1(data).hexdigest()
+        if not self.is_object_exist(object_id):
+            self.save_object(object_id, lambda fh: fh.write(data))
+        return object_id
+
+    def read_data(self, object_id):
+        try:
+            with open(self.get_object_path(object_id), 'rb') as fh:
+                return fh.read()
+        except FileNotFoundError:
+            pack, offset = self.find_packed(object_id)
+            if pack is None:
+                # a long running process, as the daemon, may have loaded the packs before a gc of another process
+                self.get_packs(is_rescan=True)
+                pack, offset = self.find_packed(object_id)
+            if pack is None:
+                raise
+            return pack.read_entry(offset)
+
+    def get_object_file(self, object_id):
+        # path of the object content, a packed object or large file is rebuilt to a temporary file
+        object_path = self.get_object_path(object_id)
+        chunks = self.read_chunk_list(object_id)
+        if chunks is None and os.path.isfile(object_path):
+            return object_path
+        if object_id not in self.extracted_files:
+            # next to the objects, removed when wit exits - a loose copy would undo the gc
+            fd, temp_path = make_temp_file(self.objects_dir, suffix='.file')
+            atexit.register(os.remove, temp_path)
+            with open(fd, 'wb', buffering=0) as fh:
+                if chunks is not None:
+                    self.write_chunks(chunks, fh)
+                else:
+                    fh.write(self.read_data(object_id))
+            self.extracted_files[object_id] = temp_path
+        return self.extracted_files[object_id]
+
+    def read_chunk_list(self, object_id):
+        # [(chunk id, size)] of a large file, None for an object stored whole
+        try:
+            with open(self.get_object_path(object_id), 'rb') as fh:
+                if fh.read(len(CHUNKED_HEADER)) != CHUNKED_HEADER:
+                    return None
+                return parse_chunk_list(CHUNKED_HEADER + fh.read())
+        except FileNotFoundError:
+            data = self.read_data(object_id)
+            return parse_chunk_list(data) if data.startswith(CHUNKED_HEADER) else None
+
+    def write_chunks(self, chunks, target_fh):
+        # rebuild a large file into an unbuffered file, loose chunks are copied in the kernel
+        for chunk_id, size in chunks:
+            try:
+                with open(self.get_object_path(chunk_id), 'rb', buffering=0) as fh:
+                    append_file_data(fh, target_fh, size)
+            except FileNotFoundError:
+                target_fh.write(self.read_data(chunk_id))
+
+    def iter_loose_ids(self):
+        with os.scandir(self.objects_dir) as folders:
+            for folder in folders:
+                if len(folder.name) == 2 and folder.is_dir():
+                    for item in os.scandir(folder.path):
+                        # skip temporary files of an interrupted write
+                        if len(item.name) == 38:
+                            yield folder.name + item.name
+
+    @traced('repack')
+    def repack(self, delta_bases):
+        ''' Move every object, loose or packed, to one new pack and remove the old copies.
+        Args: delta_bases - [(object id, delta base object id or None)], a base listed before the
+                            objects using it. Objects which are not listed are stored whole.
+        Return: (number of objects, number of deltas)
+        '''
+        packs = self.get_packs()
+        object_ids = chain(delta_bases, ((object_id, None) for object_id in self.iter_loose_ids()),
+                           ((object_id, None) for pack in packs for object_id in pack.iter_ids()))
+        offsets, depths = {}, {}
+        os.makedirs(self.pack_dir, exist_ok=True)
+        fd, temp_path = make_temp_file(self.pack_dir, 0o444)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(Pack.HEADER)
+            for object_id, base_id in object_ids:
+                if object_id in offsets or not self.is_object_exist(object_id):
+                    continue
+                content = data = self.read_data(object_id)
+                kind, base_offset, depths[object_id] = Pack.FULL, 0, 0
+                if base_id in offsets and depths[base_id] < MAX_DELTA_DEPTH and len(data) <= DELTA_SIZE_LIMIT:
+                    delta = create_delta(self.read_data(base_id), data, len(data) // 2)
+                    if delta is not None:
+                        content, kind, base_offset, depths[object_id] = delta, Pack.DELTA, offsets[base_id], depths[base_id] + 1
+                content = zlib.compress(content)
+                offsets[object_id] = fh.tell()
+                fh.write(Pack.ENTRY.pack(kind, base_offset, len(content)))
+                fh.write(content)
+        # name the pack by its content, the index goes last as it makes the pack visible
+        pack_name = hashlib.sha1(''.join(sorted(offsets)).encode()).hexdigest()
+        pack_file = os.path.join(self.pack_dir, 'pack-{}.pack'.format(pack_name))
+        os.replace(temp_path, pack_file)
+        IdIndex(pack_file[:-len('.pack')] + '.idx', '>Q').write(
+            (bytes.fromhex(object_id), offset) for object_id, offset in offsets.items())
+        for pack in packs:
+            if pack.pack_file != pack_file:
+                os.remove(pack.index.index_file)
+                os.remove(pack.pack_file)
+        for object_id in list(self.iter_loose_ids()):
+            if object_id in offsets:
+                os.remove(self.get_object_path(object_id))
+        for folder in os.scandir(self.objects_dir):
+            if len(folder.name) == 2 and folder.is_dir() and not any(os.scandir(folder.path)):
+                os.rmdir(folder.path)
+        self.packs = None
+        return len(offsets), sum(1 for depth in depths.values() if depth)
+
+    def write_blob(self, path):
+        with open(path, 'rb') as fh:
+            chunks = get_file_chunks(fh)
+            if chunks is not None:
+                # only the chunks which are not stored yet are written
+                for chunk_id, start, end in chunks:
+                    if not self.is_object_exist(chunk_id):
+                        self.save_object(chunk_id, lambda out, start=start, end=end: out.write(
+                            os.pread(fh.fileno(), end - start, start)))
+                return self.write_data(format_chunk_list(chunks))
+        object_id = hash_file(path)
+        if not self.is_object_exist(object_id):
+            self.save_object(object_id, partial(
+                copy_file_data, path, link_mode=self.link_mode))
+        return object_id
+
+    def write_tree(self, directory):
+        ''' Store directory content recursively.
+        Args: directory - folder to store
+        Return: tree object id
+        '''
+        entries = []
+        with os.scandir(directory) as dir_content:
+            items = sorted(dir_content, key=lambda entry: entry.name)
+        files = [item for item in items if not item.is_dir()]
+        blob_ids = dict(zip((item.name for item in files), self.write_blobs(
+            [item.path for item in files])))
+        for item in items:
+            if item.name in blob_ids:
+                entries.append((get_file_mode(item.path), 'blob',
+                                blob_ids[item.name], item.name))
+            else:
+                entries.append(
+                    (TREE_MODE, 'tree', self.write_tree(item.path), item.name))
+        return self.write_tree_entries(entries)
+
+    @traced('store files')
+    def write_blobs(self, paths):
+        return run_jobs(self.write_blob, paths, self.jobs)
+
+    def write_tree_entries(self, entries):
+        data = ''.join('{} {} {}\t{}\n'.format(*entry) for entry in entries)
+        return self.write_data(data.encode())
+
+    def write_tree_from_files(self, files):
+        ''' Store the tree objects of a flat file list, only the folders on the current path are kept open.
+        Args: files - iterable of (relative path, (mode, blob id)) in path parts order
+        Return: root tree object id
+        '''
+        # names and tree entries of the open folders, from the root down
+        folder_names = []
+        folder_entries = [[]]
+        for path, (mode, blob_id) in files:
+            *folders, name = path.split(os.sep)
+            common = 0
+            while common < min(len(folders), len(folder_names)) and folders[common] == folder_names[common]:
+                common += 1
+            while len(folder_names) > common:
+                self.close_tree_folder(folder_names, folder_entries)
+            for folder in folders[common:]:
+                folder_names.append(folder)
+                folder_entries.append([])
+            folder_entries[-1].append((mode, 'blob', blob_id, name))
+        while folder_names:
+            self.close_tree_folder(folder_names, folder_entries)
+        return self.write_tree_entries(folder_entries[0])
+
+    def close_tree_folder(self, folder_names, folder_entries):
+        # store the deepest open folder and add it to its parent
+        tree_id = self.write_tree_entries(folder_entries.pop())
+        folder_entries[-1].append((TREE_MODE, 'tree', tree_id, folder_names.pop()))
+
+    def read_tree(self, tree_id):
+        entries = []
+        for line in self.read_data(tree_id).decode().splitlines():
+            header, name = line.split('\t', 1)
+            mode, object_type, object_id = header.split(' ')
+            entries.append((mode, object_type, object_id, name))
+        return entries
+
+    def iter_tree_files(self, tree_id, prefix=''):
+        for mode, object_type, object_id, name in self.read_tree(tree_id):
+            path = os.path.join(prefix, name)
+            if object_type == 'tree':
+                yield from self.iter_tree_files(object_id, path)
             else:
-                self.create_references_file(commit_id, master, self.branches)
-        elif flow == 'checkout':
-            if commit_id != master:
-                self.create_references_file(commit_id, master, self.branches)
+                yield path, mode, object_id
+
+    def checkout_blob(self, blob_id, mode, target_path):
+        # write next to the target and rename, an interrupted checkout never leaves a partial file
+        object_path = self.get_object_path(blob_id)
+        temp_path = '{}.wit-{}'.format(target_path, os.getpid())
+        try:
+            chunks = self.read_chunk_list(blob_id)
+            if chunks is not None:
+                with open(temp_path, 'wb', buffering=0) as fh:
+                    self.write_chunks(chunks, fh)
+                os.chmod(temp_path, int(mode[-3:], 8))
+            elif not os.path.isfile(object_path):
+                # packed object, written straight out of the pack
+                with open(temp_path, 'wb') as fh:
+                    fh.write(self.read_data(blob_id))
+                os.chmod(temp_path, int(mode[-3:], 8))
             else:
-                self.create_references_file(
-                    commit_id, commit_id, self.branches)
+                with open(temp_path, 'wb') as fh:
+                    copy_file_data(object_path, fh, self.link_mode)
+                os.chmod(temp_path, int(mode[-3:], 8))
+            trace_bytes(temp_path)
+            os.replace(temp_path, target_path)
+        except BaseException:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
 
-    def get_branches(self):
-        if not os.path.exists(self.wit_references_file):
-            raise WitException('Cannot read reference file.')
-        self.branches = self.get_references_file_data()
-        self.branches.pop("HEAD")
-        return self.branches
+    @traced('write files')
+    def checkout_blobs(self, blobs):
+        ''' Writes (blob id, mode, target path) items and override existing files. '''
+        for _, _, target_path in blobs:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        run_jobs(lambda blob: self.checkout_blob(*blob), blobs, self.jobs)
 
-    def update_branches(self, branch_name):
-        if not os.path.exists(self.wit_references_file):
-            raise WitException('Cannot read reference file.')
-        head_commit_id = self.get_current_commit_id()
-        self.branches = self.get_branches()  # branches contain 'master'
-        if branch_name in self.branches:
-            raise WitException(
-                'Branch name "{}" already exists.'.format(branch_name))
-        new_branch = {}
-        new_branch[branch_name] = head_commit_id
-        self.branches.update(new_branch)
-        # split 'master' from branches before create file
-        master = self.branches.pop('master')
-        self.create_references_file(head_commit_id, master, self.branches)
+    def iter_tree_diff(self, old_tree_id, new_tree_id, prefix=''):
+        ''' Compare two trees, sub trees with the same id are skipped without being read.
+        Args: old_tree_id, new_tree_id - tree object ids, None for an empty tree
+        Return: generator of (path, old (mode, blob id), new (mode, blob id)), None for a missing side.
+                Removals under a path are yielded before additions to it.
+        '''
+        if old_tree_id == new_tree_id:
+            return
+        old_entries = self.get_tree_entries(old_tree_id)
+        new_entries = self.get_tree_entries(new_tree_id)
+        for name in sorted(old_entries.keys() | new_entries.keys()):
+            old_entry, new_entry = old_entries.get(name), new_entries.get(name)
+            if old_entry == new_entry:
+                continue
+            path = os.path.join(prefix, name)
+            old_blob, old_tree = split_tree_entry(old_entry)
+            new_blob, new_tree = split_tree_entry(new_entry)
+            if old_blob is not None and new_blob is None:
+                yield path, old_blob, None
+            if old_tree != new_tree:
+                yield from self.iter_tree_diff(old_tree, new_tree, path)
+            if new_blob is not None and new_blob != old_blob:
+                yield path, old_blob, new_blob
+
+    def get_tree_entry(self, tree_id, path):
+        ''' Return: (mode, type, id) of a relative path in a tree, None if it is not there '''
+        entry = (TREE_MODE, 'tree', tree_id)
+        for name in path.split(os.sep) if path else []:
+            if entry is None or entry[1] != 'tree':
+                return None
+            entry = self.get_tree_entries(entry[2]).get(name)
+        return entry
+
+    def get_tree_entries(self, tree_id):
+        if tree_id is None:
+            return {}
+        return {name: (mode, object_type, object_id) for mode, object_type, object_id, name in self.read_tree(tree_id)}
+
+
+IndexEntry = namedtuple('IndexEntry', ['mode', 'blob_id', 'size', 'mtime_ns', 'ino'])
+
+
+class Index:
+    ''' The staging area, saved in .wit/index.
+    Maps every tracked path to its staged blob and to the stat data (size, mtime_ns, inode)
+    of the working file at the time it was hashed, so unchanged files are never read again.
+    Entries are kept in columns in path parts order, the order of a tree walk: all paths in one
+    string with an offsets array, modes and stat data in arrays, blob ids as 20 byte binary ids.
+    New and removed paths are kept in a dict over the columns until the index is loaded again.
+    '''
+
+    def __init__(self, index_file) -> None:
+        self.index_file = index_file
+        self.timestamp_ns = 0
+        self.is_changed = False
+        self.path_data = ''
+        self.offsets = array('Q', [0])
+        self.modes = array('I')
+        self.blob_ids = bytearray()
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.inodes = array('q')
+        self.last_row = 0
+        # path: IndexEntry set over the columns, None for a removed row
+        self.changed = {}
+        if os.path.exists(index_file):
+            self.timestamp_ns = os.stat(index_file).st_mtime_ns
+            self.load()
+
+    def load(self):
+        # lines go straight into the columns, only the last path is kept to check the order -
+        # with the separator as '\0' plain string order is path parts order
+        path_data = io.StringIO()
+        last_key = None
+        is_sorted = True
+        with open(self.index_file) as fh:
+            for line in fh:
+                header, path = line.rstrip('\n').split('\t', 1)
+                mode, blob_id, size, mtime_ns, ino = header.split(' ')
+                key = path.replace(os.sep, '\0')
+                if last_key is not None and key <= last_key:
+                    is_sorted = False
+                last_key = key
+                path_data.write(path)
+                self.offsets.append(self.offsets[-1] + len(path))
+                self.modes.append(int(mode, 8))
+                self.blob_ids += bytes.fromhex(blob_id)
+                self.sizes.append(int(size))
+                self.mtimes.append(int(mtime_ns))
+                self.inodes.append(int(ino))
+        self.path_data = path_data.getvalue()
+        if not is_sorted:
+            # saved in plain string order by an older version
+            self.sort_rows()
+
+    def sort_rows(self):
+        order = sorted(range(len(self.modes)), key=lambda row: self.get_path(row).split(os.sep))
+        paths = [self.get_path(row) for row in order]
+        self.path_data = ''.join(paths)
+        self.offsets = array('Q', [0])
+        for path in paths:
+            self.offsets.append(self.offsets[-1] + len(path))
+        self.modes = array('I', (self.modes[row] for row in order))
+        self.blob_ids = bytearray().join(self.blob_ids[row * 20:row * 20 + 20] for row in order)
+        self.sizes = array('q', (self.sizes[row] for row in order))
+        self.mtimes = array('q', (self.mtimes[row] for row in order))
+        self.inodes = array('q', (self.inodes[row] for row in order))
+        self.is_changed = True
+
+    def get_path(self, row):
+        return self.path_data[self.offsets[row]:self.offsets[row + 1]]
+
+    def get_row_entry(self, row):
+        return IndexEntry('{:06o}'.format(self.modes[row]), self.blob_ids[row * 20:row * 20 + 20].hex(),
+                          self.sizes[row], self.mtimes[row], self.inodes[row])
+
+    def bisect_rows(self, key):
+        # first row whose path parts are not less than key
+        low, high = 0, len(self.modes)
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_path(middle).split(os.sep) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find_row(self, path):
+        # a walk looks paths up in row order, the last row found and the one after it are tried first
+        for row in (self.last_row, self.last_row + 1):
+            if row < len(self.modes) and self.get_path(row) == path:
+                self.last_row = row
+                return row
+        row = self.bisect_rows(path.split(os.sep))
+        if row < len(self.modes) and self.get_path(row) == path:
+            self.last_row = row
+            return row
+        return None
+
+    def get(self, path, default=None):
+        if path in self.changed:
+            entry = self.changed[path]
+        else:
+            row = self.find_row(path)
+            entry = None if row is None else self.get_row_entry(row)
+        return default if entry is None else entry
+
+    def __getitem__(self, path):
+        entry = self.get(path)
+        if entry is None:
+            raise KeyError(path)
+        return entry
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+    def __iter__(self):
+        return (path for path, _ in self.items())
+
+    def get_folder_rows(self, folder):
+        # range of the rows under a folder, all of them for ''
+        if not folder:
+            return 0, len(self.modes)
+        key = folder.split(os.sep)
+        # a file at the folder path itself sorts before key + [''], '\0' ends the folder name
+        return self.bisect_rows(key + ['']), self.bisect_rows(key[:-1] + [key[-1] + '\0'])
+
+    def items(self, folder=''):
+        ''' Args: folder - only the files under it, all of them for ''
+        Return: generator of (path, IndexEntry) in path parts order
+        '''
+        start, end = self.get_folder_rows(folder)
+        rows = ((path, self.get_row_entry(row)) for row, path in (
+            (row, self.get_path(row)) for row in range(start, end)) if path not in self.changed)
+        prefix = folder + os.sep if folder else ''
+        added = sorted(((path, entry) for path, entry in self.changed.items()
+                        if entry is not None and path.startswith(prefix)), key=lambda item: item[0].split(os.sep))
+        if not added:
+            return rows
+        return heapq.merge(rows, added, key=lambda item: item[0].split(os.sep))
+
+    def get_folder(self, folder):
+        ''' Return: {name: is it a folder} of the tracked entries right in a folder, '' for the root '''
+        children = {}
+        depth = len(folder.split(os.sep)) if folder else 0
+        if self.changed:
+            # changed since it was loaded, the overlay has to be merged in
+            for path, _ in self.items(folder):
+                parts = path.split(os.sep)
+                children[parts[depth]] = len(parts) > depth + 1
+            return children
+        row, end = self.get_folder_rows(folder)
+        while row < end:
+            parts = self.get_path(row).split(os.sep)
+            children[parts[depth]] = len(parts) > depth + 1
+            # a sub folder is skipped in one step
+            row = row + 1 if len(parts) == depth + 1 else self.bisect_rows(parts[:depth] + [parts[depth] + '\0'])
+        return children
+
+    def is_folder(self, folder):
+        return next(self.items(folder), None) is not None
+
+    def iter_blobs(self):
+        return ((path, entry.blob_id) for path, entry in self.items())
+
+    def iter_tree_files(self):
+        return ((path, (entry.mode, entry.blob_id)) for path, entry in self.items())
+
+    @traced('save index')
+    def save(self):
+        fd, temp_path = make_temp_file(os.path.dirname(self.index_file))
+        with os.fdopen(fd, 'w') as fh:
+            for path, entry in self.items():
+                fh.write('{} {} {} {} {}\t{}\n'.format(*entry, path))
+        os.replace(temp_path, self.index_file)
+        self.is_changed = False
+
+    def set_entry(self, path, mode, blob_id, stat_result=None):
+        if stat_result is None:
+            # unknown working file - force a hash on next compare
+            entry = IndexEntry(mode, blob_id, -1, -1, -1)
+        else:
+            entry = IndexEntry(mode, blob_id, stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+        row = None if path in self.changed else self.find_row(path)
+        if row is None:
+            self.changed[path] = entry
+        else:
+            # an existing row is changed in place
+            self.modes[row] = int(mode, 8)
+            self.blob_ids[row * 20:row * 20 + 20] = bytes.fromhex(blob_id)
+            self.sizes[row], self.mtimes[row], self.inodes[row] = entry.size, entry.mtime_ns, entry.ino
+        self.is_changed = True
+
+    def refresh_entry(self, path, stat_result):
+        entry = self[path]
+        self.set_entry(path, entry.mode, entry.blob_id, stat_result)
+
+    def remove_entries(self, path):
+        # remove a file or all files under a folder, the rows of a folder are next to each other
+        key = path.split(os.sep)
+        rows = []
+        row = self.bisect_rows(key)
+        while row < len(self.modes) and self.get_path(row).split(os.sep)[:len(key)] == key:
+            rows.append(self.get_path(row))
+            row += 1
+        added = [item for item, entry in self.changed.items() if entry is not None and self.find_row(item) is None
+                 and (item == path or item.startswith(path + os.sep))]
+        removed = [item for item in rows if self.changed.get(item, True) is not None] + added
+        for item in rows:
+            self.changed[item] = None
+        for item in added:
+            del self.changed[item]
+        self.is_changed = self.is_changed or bool(removed)
+        return removed
+
+    def is_up_to_date(self, path, stat_result):
+        if path in self.changed:
+            entry = self[path]
+            stat_data = entry.size, entry.mtime_ns, entry.ino
+        else:
+            row = self.find_row(path)
+            if row is None:
+                raise KeyError(path)
+            stat_data = self.sizes[row], self.mtimes[row], self.inodes[row]
+        if stat_result.st_mtime_ns >= self.timestamp_ns:
+            # file changed in the same tick the index was written, stat data can't be trusted
+            return False
+        return stat_data == (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino)
+
+
+class SparsePatterns:
+    ''' Paths checked out in the working directory, saved in .wit/sparse-checkout.
+    Every line is a path from the repository root, a folder takes everything under it.
+    A path part may hold shell wildcards - "src/*/docs".
+    Index entries of other paths are kept and committed, their files are not written or scanned.
+    '''
+
+    def __init__(self, lines) -> None:
+        self.lines = [line.strip().strip('/') for line in lines if line.strip() and not line.startswith('#')]
+        self.patterns = [line.split('/') for line in self.lines]
+
+    def matches(self, path):
+        parts = path.split(os.sep)
+        return any(len(parts) >= len(pattern) and all(map(fnmatchcase, parts, pattern))
+                   for pattern in self.patterns)
+
+    def is_walked(self, folder):
+        # the folder matches, or holds paths which match
+        parts = folder.split(os.sep) if folder else []
+        return any(all(map(fnmatchcase, parts, pattern)) for pattern in self.patterns)
+
+
+class CommitGraph:
+    ''' Append only .wit/commit-graph file, memory mapped on read.
+    One fixed size record per commit, parents always before children:
+    commit id (20 bytes), first and second parent record positions, generation number, timestamp.
+    Ids are looked up in .wit/commit-graph.idx, an id index of record positions. Records
+    appended after the index was written are searched directly until there are enough of
+    them to rewrite it.
+    '''
+    HEADER = b'WITG\x00\x00\x00\x01'
+    RECORD = struct.Struct('>20sIIIq')
+    NO_PARENT = 0xFFFFFFFF
+    INDEX_TAIL_LIMIT = 1024
+
+    def __init__(self, graph_file) -> None:
+        self.graph_file = graph_file
+        self.data = b''
+        self.index = IdIndex(graph_file + '.idx', '>I')
+
+    @traced('load commit graph')
+    def load(self):
+        self.data = b''
+        if os.path.getsize(self.graph_file) > len(self.HEADER):
+            with open(self.graph_file, 'rb') as fh:
+                self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index.load()
+        # keep the unsorted tail small, rewriting costs O(n log n) once every n / 16 commits
+        if len(self) - len(self.index) > max(self.INDEX_TAIL_LIMIT, len(self.index) // 16):
+            self.index.write((self.get_raw_id(position), position) for position in range(len(self)))
+        return self
+
+    def create(self):
+        with open(self.graph_file, 'wb') as fh:
+            fh.write(self.HEADER)
+        # the id index and the changed path filters follow the record positions
+        for path in (self.index.index_file, *ChangedPathFilters.get_files(self.graph_file)):
+            if os.path.exists(path):
+                os.remove(path)
+        return self.load()
+
+    def __len__(self):
+        return max(len(self.data) - len(self.HEADER), 0) // self.RECORD.size
+
+    def get_record(self, position):
+        ''' Return: (commit id, parent positions, generation number, timestamp) '''
+        raw_id, first_parent, second_parent, generation, timestamp = self.RECORD.unpack_from(
+            self.data, len(self.HEADER) + position * self.RECORD.size)
+        parents = [parent for parent in (first_parent, second_parent) if parent != self.NO_PARENT]
+        return raw_id.hex(), parents, generation, timestamp
+
+    def get_raw_id(self, position):
+        offset = len(self.HEADER) + position * self.RECORD.size
+        return self.data[offset:offset + 20]
+
+    def get_commit_id(self, position):
+        return self.get_raw_id(position).hex()
+
+    def find(self, commit_id):
+        matches = self.find_prefix(commit_id, limit=1)
+        return matches[0] if matches else None
+
+    def find_prefix(self, prefix, limit=2):
+        ''' Record positions of the commits whose id starts with a hex prefix
+        Args: limit - stop after that many matches, two are enough to tell an ambiguous prefix
+        '''
+        matches = self.index.find_prefix(prefix, limit)
+        # then scan the records appended after the index, a match must start on a record boundary
+        key = bytes.fromhex(prefix[:len(prefix) - len(prefix) % 2])
+        tail = len(self.HEADER) + len(self.index) * self.RECORD.size
+        offset = self.data.find(key, tail) if len(self) > len(self.index) else -1
+        while offset != -1 and len(matches) < limit:
+            position, remainder = divmod(offset - len(self.HEADER), self.RECORD.size)
+            if remainder == 0 and self.get_commit_id(position).startswith(prefix):
+                matches.append(position)
+            offset = self.data.find(key, offset + 1)
+        return matches
+
+    def append(self, commit_id, parent_ids, timestamp):
+        parents = [self.find(parent_id) for parent_id in parent_ids]
+        generation = 1 + max((self.get_record(parent)[2] for parent in parents), default=0)
+        parents = (parents + [self.NO_PARENT, self.NO_PARENT])[:2]
+        record = self.RECORD.pack(bytes.fromhex(commit_id), parents[0], parents[1], generation, timestamp)
+        with open(self.graph_file, 'ab') as fh:
+            fh.write(record)
+        return self.load()
+
+    def get_generation(self, position):
+        return self.get_record(position)[2]
+
+    def get_merge_bases(self, first, second):
+        ''' Lowest common ancestors of two commits.
+        Walks both histories together, highest generation number first, and stops as soon as
+        every commit left to visit is an ancestor of a common ancestor already found.
+        Args: first, second - record positions
+        Return: list of record positions, more than one for a criss-cross history
+        '''
+        if first == second:
+            return [first]
+        first_side, second_side, stale = 1, 2, 4
+        both_sides = first_side | second_side
+        flags = defaultdict(int)
+        flags[first] |= first_side
+        flags[second] |= second_side
+        queue = [(-self.get_generation(first), -first), (-self.get_generation(second), -second)]
+        heapq.heapify(queue)
+        candidates = []
+        while any(not flags[-position] & stale for _, position in queue):
+            _, position = heapq.heappop(queue)
+            position = -position
+            position_flags = flags[position] & (both_sides | stale)
+            if position_flags & both_sides == both_sides:
+                if position not in candidates:
+                    candidates.append(position)
+                position_flags |= stale
+            for parent in self.get_record(position)[1]:
+                if flags[parent] & position_flags == position_flags:
+                    continue
+                flags[parent] |= position_flags
+                heapq.heappush(queue, (-self.get_generation(parent), -parent))
+        candidates = [item for item in candidates if not flags[item] & stale]
+        # drop a candidate which is an ancestor of another one
+        return [item for item in candidates
+                if not any(other != item and self.is_ancestor(item, other) for other in candidates)]
+
+    def is_ancestor(self, ancestor, position):
+        # commits with a lower generation number than ancestor can't lead to it
+        generation = self.get_generation(ancestor)
+        visited = set()
+        stack = [position]
+        while stack:
+            item = stack.pop()
+            if item == ancestor:
+                return True
+            if item in visited or self.get_generation(item) <= generation:
+                continue
+            visited.add(item)
+            stack.extend(self.get_record(item)[1])
+        return False
+
+    def iter_newest_first(self, positions, since=None):
+        ''' Walk commits and their ancestors lazily, newest commit date first.
+        Args: since - timestamp, older commits and their ancestors are not walked
+        Return: generator of record positions
+        '''
+        # (negative timestamp, negative position) - newest first, later record first on equal dates
+        visited = set(positions)
+        heap = [(-self.get_record(position)[3], -position) for position in visited]
+        heapq.heapify(heap)
+        while heap:
+            _, negative_position = heapq.heappop(heap)
+            _, parents, _, timestamp = self.get_record(-negative_position)
+            if since is not None and timestamp < since:
+                continue
+            yield -negative_position
+            for parent in parents:
+                if parent not in visited:
+                    visited.add(parent)
+                    heapq.heappush(heap, (-self.get_record(parent)[3], -parent))
+
+    def iter_topo_order(self, positions, since=None):
+        ''' Walk commits and their ancestors lazily, every commit after all of its children.
+        A commit is followed by its first parent when possible, so a branch stays together.
+        Children have higher generation numbers, so once the walk explored every commit of a
+        higher generation than a commit, all of its children are known.
+        Args: since - timestamp, older commits and their ancestors are not walked
+        Return: generator of record positions
+        '''
+        def is_walked(position):
+            return since is None or self.get_record(position)[3] >= since
+        discovered = set(position for position in positions if is_walked(position))
+        explore = [(-self.get_generation(position), position) for position in discovered]
+        heapq.heapify(explore)
+        children_left = defaultdict(int)
+        # stack of commits to show, highest generation on top
+        ready = sorted(discovered, key=self.get_generation)
+        shown = set()
+        while ready:
+            position = ready.pop()
+            if position in shown:
+                continue
+            generation = self.get_generation(position)
+            while explore and -explore[0][0] >= generation:
+                _, explored = heapq.heappop(explore)
+                for parent in self.get_record(explored)[1]:
+                    if is_walked(parent):
+                        children_left[parent] += 1
+                        if parent not in discovered:
+                            discovered.add(parent)
+                            heapq.heappush(explore, (-self.get_generation(parent), parent))
+            if children_left[position] > 0:
+                # shown after its last child, which puts it back on the stack
+                continue
+            shown.add(position)
+            yield position
+            for parent in reversed(self.get_record(position)[1]):
+                if parent in discovered:
+                    children_left[parent] -= 1
+                    if children_left[parent] == 0:
+                        ready.append(parent)
+
+
+def iter_filter_bits(path, size):
+    # double hashing, every path sets PATH_FILTER_HASHES bits out of size
+    first, second = struct.unpack('>II', hashlib.blake2b(path.encode(), digest_size=8).digest())
+    return ((first + number * second) % size for number in range(PATH_FILTER_HASHES))
+
+
+def make_path_filter(paths):
+    ''' Bloom filter of changed file paths and of their folders.
+    Return: bytes, empty when nothing changed, a single 0xff byte - which matches every path - for too many paths
+    '''
+    keys = set()
+    for path in paths:
+        parts = path.split(os.sep)
+        keys.update(os.sep.join(parts[:depth]) for depth in range(1, len(parts) + 1))
+    if len(keys) > PATH_FILTER_LIMIT:
+        return b'\xff'
+    bloom = bytearray((len(keys) * PATH_FILTER_BITS + 7) // 8)
+    for key in keys:
+        for bit in iter_filter_bits(key, len(bloom) * 8):
+            bloom[bit // 8] |= 1 << (bit % 8)
+    return bytes(bloom)
+
+
+def is_in_path_filter(bloom, path):
+    # False - path surely did not change, True - it may have
+    return bool(bloom) and all(bloom[bit // 8] >> (bit % 8) & 1 for bit in iter_filter_bits(path, len(bloom) * 8))
+
+
+class ChangedPathFilters:
+    ''' Bloom filters of the paths every commit changed against its first parent, next to the commit graph.
+    History of a path skips the commits whose filter rules the path out without reading their trees,
+    only the few false positives are compared exactly.
+    Filters are appended in commit graph record order to .wit/commit-graph.bloom, and the end offset of
+    every filter to .wit/commit-graph.bidx. An offset is written after its filter, so a torn append is
+    ignored and overwritten by the next one.
+    '''
+    OFFSET = struct.Struct('>Q')
+
+    def __init__(self, graph_file) -> None:
+        self.data_file, self.offsets_file = self.get_files(graph_file)
+        self.data = b''
+        self.offsets = b''
+
+    @staticmethod
+    def get_files(graph_file):
+        return graph_file + '.bloom', graph_file + '.bidx'
+
+    def load(self):
+        self.data, self.offsets = b'', b''
+        if os.path.exists(self.offsets_file) and os.path.getsize(self.offsets_file) >= self.OFFSET.size:
+            with open(self.offsets_file, 'rb') as fh:
+                self.offsets = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.get_end(len(self)):
+                with open(self.data_file, 'rb') as fh:
+                    self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __len__(self):
+        return len(self.offsets) // self.OFFSET.size
+
+    def get_end(self, count):
+        # end offset of the first count filters
+        return self.OFFSET.unpack_from(self.offsets, (count - 1) * self.OFFSET.size)[0] if count else 0
+
+    def get_filter(self, position):
+        return self.data[self.get_end(position):self.get_end(position + 1)]
+
+    def is_changed(self, position, paths):
+        ''' Args: paths - relative paths, '' for the whole tree
+        Return: False if the commit surely changed none of the paths, True if it may have
+        '''
+        if position >= len(self) or '' in paths:
+            return True
+        bloom = self.get_filter(position)
+        if any(is_in_path_filter(bloom, path) for path in paths):
+            return True
+        trace_count('path_filter_skips')
+        return False
+
+    def append(self, filters):
+        # filters - bytes of the next record positions, in order
+        count = len(self)
+        end = self.get_end(count)
+        self.data, self.offsets = b'', b''
+        ends = array('Q')
+        with open(self.data_file, 'ab') as fh:
+            fh.truncate(end)
+            for bloom in filters:
+                fh.write(bloom)
+                end += len(bloom)
+                ends.append(end)
+        with open(self.offsets_file, 'ab') as fh:
+            fh.truncate(count * self.OFFSET.size)
+            fh.write(b''.join(self.OFFSET.pack(item) for item in ends))
+        return self.load()
+
+
+class GraphLanes:
+    ''' Columns of the text graph, each lane waits for the next commit to show on it.
+    A lane is drawn two characters wide, "|" and a gap, like git log --graph.
+    '''
+
+    def __init__(self) -> None:
+        self.lanes = []
+
+    def draw(self, marks):
+        # marks: {character column: character}
+        width = max(marks) + 1 if marks else 0
+        return ''.join(marks.get(column, ' ') for column in range(width))
+
+    def add(self, position, parents):
+        ''' Put a commit on its lane and continue the lane to its parents.
+        Return: prefix of the commit line, lines moving lanes after it
+        '''
+        if position in self.lanes:
+            column = self.lanes.index(position)
+        else:
+            self.lanes.append(position)
+            column = len(self.lanes) - 1
+        prefix = self.draw({2 * k: '*' if k == column else '|' for k in range(len(self.lanes))})
+        lines = []
+        if not parents:
+            del self.lanes[column]
+            if column < len(self.lanes):
+                marks = {2 * k: '|' for k in range(column)}
+                marks.update({2 * k + 1: '/' for k in range(column, len(self.lanes))})
+                lines.append(self.draw(marks))
+        else:
+            self.lanes[column] = parents[0]
+            for index, parent in enumerate(parents[1:], column + 1):
+                self.lanes.insert(index, parent)
+                marks = {2 * k: '|' for k in range(index)}
+                marks.update({2 * k - 1: '\\' for k in range(index, len(self.lanes))})
+                lines.append(self.draw(marks))
+        lines.extend(self.join_lanes())
+        return prefix, lines
+
+    def join_lanes(self):
+        # lanes waiting for the same commit are joined into the leftmost of them
+        while True:
+            first = {}
+            duplicate = None
+            for index, lane in enumerate(self.lanes):
+                if lane in first:
+                    duplicate = index
+                else:
+                    first[lane] = index
+            if duplicate is None:
+                return
+            target = first[self.lanes[duplicate]]
+            del self.lanes[duplicate]
+            marks = {2 * k: '|' for k in range(duplicate)}
+            marks.update({2 * k + 1: '_' for k in range(target, duplicate - 1)})
+            marks[2 * duplicate - 1] = '/'
+            marks.update({2 * k + 1: '/' for k in range(duplicate, len(self.lanes))})
+            yield self.draw(marks)
+
+
+class References:
+    ''' Commit ids of HEAD and the branches, read once per process.
+    .wit/references.txt holds "name=commit id" lines of HEAD, master and recently changed branches,
+    .wit/packed-refs holds the other branches sorted by name. A name in references.txt hides
+    the same name in packed-refs.
+    An update is a transaction: .wit/references.txt.lock is created exclusively, every changed
+    reference must still hold the commit id the caller saw, then the new file is written
+    next to the old one and renamed over it.
+    '''
+
+    def __init__(self, references_file, packed_file) -> None:
+        self.references_file = references_file
+        self.packed_file = packed_file
+        self.lock_file = references_file + '.lock'
+        self.loose = {}
+        self.packed = {}
+
+    @traced('read references')
+    def load(self):
+        self.loose = self.read(self.references_file)
+        self.packed = self.read(self.packed_file)
+        return self
+
+    @staticmethod
+    def read(references_file):
+        if not os.path.exists(references_file):
+            return {}
+        with open(references_file) as fh:
+            return dict(line.rstrip('\n').split('=', 1) for line in fh if line.strip() and not line.startswith('#'))
+
+    @staticmethod
+    def write(references_file, references):
+        fd, temp_path = make_temp_file(os.path.dirname(references_file))
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(''.join('{}={}\n'.format(name, commit_id) for name, commit_id in references.items()))
+        os.replace(temp_path, references_file)
+
+    def get(self, name, default=None):
+        if name in self.loose:
+            return self.loose[name]
+        return self.packed.get(name, default)
+
+    def get_all(self):
+        # HEAD and master come first, as in references.txt
+        references = dict(self.loose)
+        for name, commit_id in self.packed.items():
+            references.setdefault(name, commit_id)
+        return references
+
+    def lock(self):
+        deadline = time.monotonic() + REFS_LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except FileExistsError:
+                if time.monotonic() > deadline:
+                    raise WitException('Unable to lock references, remove {} if no other wit command is running.'.format(
+                        self.lock_file))
+                time.sleep(0.01)
+
+    @traced('write references')
+    def update(self, changes, pack=False):
+        ''' Change references all at once.
+        Args: changes - {name: (expected commit id - None for a new name, new commit id)}
+              pack - move every branch but master to packed-refs, done anyway once there are many
+        Raises: WitException if a reference was changed by another process, or they stay locked
+        '''
+        self.lock()
+        try:
+            current = References(self.references_file, self.packed_file).load()
+            for name, (expected, _) in changes.items():
+                if current.get(name) != expected:
+                    raise WitException('Reference "{}" was changed by another wit command, try again.'.format(name))
+            loose, packed = current.loose, current.packed
+            loose.update((name, commit_id) for name, (_, commit_id) in changes.items())
+            if pack or len(loose) > LOOSE_REFS_LIMIT:
+                # packed-refs first - a crash in between leaves both copies, which agree
+                packed.update((name, commit_id) for name, commit_id in loose.items() if name not in ('HEAD', 'master'))
+                packed = dict(sorted(packed.items()))
+                self.write(self.packed_file, packed)
+                loose = {name: commit_id for name, commit_id in loose.items() if name in ('HEAD', 'master')}
+            self.write(self.references_file, loose)
+            self.loose, self.packed = loose, packed
+        finally:
+            os.remove(self.lock_file)
+
+
+def translate_ignore_glob(part):
+    # regex of one path part of a .witignore pattern, without capturing groups
+    regex = []
+    index = 0
+    while index < len(part):
+        char = part[index]
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        elif char == '\\' and index + 1 < len(part):
+            index += 1
+            regex.append(re.escape(part[index]))
+        elif char == '[' and part.find(']', index + 2) != -1:
+            end = part.find(']', index + 2)
+            chars = part[index + 1:end].replace('\\', '\\\\')
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            regex.append('[{}]'.format(chars))
+            index = end
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return ''.join(regex)
+
+
+def compile_ignore_pattern(pattern):
+    ''' Regex of a .witignore pattern, matched against paths from its folder with "/" separators.
+    A pattern with a "/" before its end is anchored to the folder, others match at any depth.
+    "**" matches any number of folders.
+    '''
+    is_anchored = '/' in pattern
+    parts = pattern.lstrip('/').split('/')
+    regex = '' if is_anchored else '(?:.*/)?'
+    for index, part in enumerate(parts):
+        is_last = index == len(parts) - 1
+        if part == '**':
+            regex += '.*' if is_last else '(?:.*/)?'
+        else:
+            regex += translate_ignore_glob(part) + ('' if is_last else '/')
+    return regex
+
+
+class IgnoreRules:
+    ''' Patterns of one .witignore file, compiled into one regex for files and one for folders.
+    Alternatives are tried from the last line up, so the group which matches is the line that decides.
+    '''
+
+    def __init__(self, lines) -> None:
+        self.negated = set()
+        file_regexes, folder_regexes = [], []
+        for number, line in enumerate(lines):
+            line = line.rstrip()
+            if not line or line.startswith('#'):
+                continue
+            name = 'line{}'.format(number)
+            if line.startswith('!'):
+                self.negated.add(name)
+                line = line[1:]
+            elif line.startswith('\\'):
+                # escaped "#" or "!"
+                line = line[1:]
+            is_folder_only = line.endswith('/')
+            regex = '(?P<{}>{})'.format(name, compile_ignore_pattern(line.rstrip('/')))
+            folder_regexes.append(regex)
+            if not is_folder_only:
+                file_regexes.append(regex)
+        self.file_regex = re.compile('|'.join(reversed(file_regexes))) if file_regexes else None
+        self.folder_regex = re.compile('|'.join(reversed(folder_regexes))) if folder_regexes else None
+
+    def match(self, path, is_folder):
+        ''' Return: True ignored, False kept by a "!" line, None if no line matches '''
+        regex = self.folder_regex if is_folder else self.file_regex
+        match = regex and regex.fullmatch(path)
+        if not match:
+            return None
+        return match.lastgroup not in self.negated
+
+
+class IgnoreMatcher:
+    ''' .witignore files of a working directory, read once per folder when the folder is first matched.
+    Rules of a deeper folder come first, and everything under an ignored folder is ignored.
+    Only untracked paths are ignored, tracked files are always compared.
+    '''
+
+    def __init__(self, workdir) -> None:
+        self.workdir = workdir
+        # folder relative path: IgnoreRules, None without a .witignore file
+        self.rules = {}
+        self.ignored_folders = {'': False}
+
+    def load(self, folder, exists=True):
+        # exists - False when the caller listed the folder and saw no .witignore, saves opening it
+        rules = None
+        if exists:
+            try:
+                with open(os.path.join(self.workdir, folder, IGNORE_FILE)) as fh:
+                    rules = IgnoreRules(fh.read().splitlines())
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        self.rules[folder] = rules
+        return rules
+
+    def match_rules(self, path, is_folder):
+        folder = path
+        while folder:
+            folder = os.path.dirname(folder)
+            rules = self.rules[folder] if folder in self.rules else self.load(folder)
+            if rules is not None:
+                is_ignored = rules.match(os.path.relpath(path, folder or '.').replace(os.sep, '/'), is_folder)
+                if is_ignored is not None:
+                    return is_ignored
+        return False
+
+    def is_folder_ignored(self, folder):
+        if folder not in self.ignored_folders:
+            self.ignored_folders[folder] = (self.is_folder_ignored(os.path.dirname(folder))
+                                            or self.match_rules(folder, True))
+        return self.ignored_folders[folder]
+
+    def is_ignored(self, path, is_folder=False):
+        if is_folder:
+            return self.is_folder_ignored(path)
+        return self.is_folder_ignored(os.path.dirname(path)) or self.match_rules(path, False)
+
+
+class WitRepo:
+    def __init__(self, wit_root_path, jobs=1) -> None:
+        self.wit_root_path = wit_root_path
+        self.jobs = jobs
+        self.wit_dir = os.path.join(self.wit_root_path, '.wit')
+        self.wit_images_dir = os.path.join(self.wit_dir, 'images')
+        self.wit_objects_dir = os.path.join(self.wit_dir, 'objects')
+        self.wit_staging_dir = os.path.join(self.wit_dir, 'staging_area')
+        self.wit_index_file = os.path.join(self.wit_dir, 'index')
+        self.wit_references_file = os.path.join(self.wit_dir, 'references.txt')
+        self.wit_active_branch_file = os.path.join(
+            self.wit_dir, 'activated.txt')
+        self.wit_config_file = os.path.join(self.wit_dir, 'config')
+        self.wit_commit_graph_file = os.path.join(self.wit_dir, 'commit-graph')
+        self.wit_merge_head_file = os.path.join(self.wit_dir, 'MERGE_HEAD')
+        self.wit_packed_refs_file = os.path.join(self.wit_dir, 'packed-refs')
+        self.wit_sparse_file = os.path.join(self.wit_dir, 'sparse-checkout')
+        self.commit_graph = None
+        self.path_filters = None
+        self.references = None
+        self.objects = ObjectStore(
+            self.wit_objects_dir, self.jobs, self.get_config().get('link_mode', LINK_MODES[0]))
+        self.branches = {}
+        self.commit_history = defaultdict(list)
+
+    def __str__(self) -> str:
+        return 'root path: {}\nwit dir: {}\nref file: {}'.format(self.wit_root_path, self.wit_dir, self.wit_references_file)
+
+    def update_wit_dir(self, new_root):
+        self.wit_root_path = new_root
+        self.wit_dir = os.path.join(self.wit_root_path, '.wit')
+        self.wit_images_dir = os.path.join(self.wit_dir, 'images')
+        self.wit_objects_dir = os.path.join(self.wit_dir, 'objects')
+        self.wit_staging_dir = os.path.join(self.wit_dir, 'staging_area')
+        self.wit_index_file = os.path.join(self.wit_dir, 'index')
+        self.wit_references_file = os.path.join(self.wit_dir, 'references.txt')
+        self.wit_active_branch_file = os.path.join(
+            self.wit_dir, 'activated.txt')
+        self.wit_config_file = os.path.join(self.wit_dir, 'config')
+        self.wit_commit_graph_file = os.path.join(self.wit_dir, 'commit-graph')
+        self.wit_merge_head_file = os.path.join(self.wit_dir, 'MERGE_HEAD')
+        self.wit_packed_refs_file = os.path.join(self.wit_dir, 'packed-refs')
+        self.wit_sparse_file = os.path.join(self.wit_dir, 'sparse-checkout')
+        self.commit_graph = None
+        self.path_filters = None
+        self.references = None
+        self.objects = ObjectStore(
+            self.wit_objects_dir, self.jobs, self.get_config().get('link_mode', LINK_MODES[0]))
+
+    def validate_repo_at_path(self, path, is_path_required):
+        self.wit_dir = self.find_repo(path, is_path_required)
+        if self.wit_dir is None:
+            raise WitException(
+                'Not a wit repository (or any of the parent directories): {}'.format('.wit'))
+        self.update_wit_dir(os.path.dirname(self.wit_dir))
+        return self.wit_dir
+
+    def find_repo(self, path='.', required=False):
+        path = os.path.realpath(path)
+        if os.path.isdir(os.path.join(path, '.wit')):
+            if required:
+                return os.path.join(path, '.wit')
+            return True
+        parent = os.path.realpath(os.path.join(path, ".."))
+        if parent == path:
+            if required:
+                return None
+            return False
+        return self.find_repo(parent, required)
+
+    def get_config(self):
+        if not os.path.exists(self.wit_config_file):
+            return {}
+        return dict(line.rstrip().split('=', 1) for line in open(self.wit_config_file) if not line.startswith("#"))
+
+    def set_config(self, name, value):
+        if name == 'link_mode' and value not in LINK_MODES:
+            raise WitException('link_mode must be one of: {}'.format(', '.join(LINK_MODES)))
+        config = self.get_config()
+        config[name] = value
+        with open(self.wit_config_file, 'w') as fh:
+            fh.write(''.join('{}={}\n'.format(key, item) for key, item in config.items()))
+
+    def get_sparse_patterns(self):
+        # None when the whole tree is checked out
+        if not os.path.exists(self.wit_sparse_file):
+            return None
+        with open(self.wit_sparse_file) as fh:
+            return SparsePatterns(fh.read().splitlines())
+
+    def set_sparse_patterns(self, sparse):
+        if sparse is None:
+            if os.path.exists(self.wit_sparse_file):
+                os.remove(self.wit_sparse_file)
+            return
+        fd, temp_path = make_temp_file(self.wit_dir)
+        with os.fdopen(fd, 'w') as fh:
+            fh.writelines(line + '\n' for line in sparse.lines)
+        os.replace(temp_path, self.wit_sparse_file)
+
+    def get_ignore_matcher(self):
+        return IgnoreMatcher(self.wit_root_path)
+
+    def get_references(self):
+        if self.references is None:
+            self.references = References(
+                self.wit_references_file, self.wit_packed_refs_file).load()
+        return self.references
+
+    def get_references_file_data(self):
+        return self.get_references().get_all()
+
+    def create_references_file(self, head, master, branches):
+        changes = {'HEAD': (None, head), 'master': (None, master)}
+        changes.update((branch_name, (None, commit_id)) for branch_name, commit_id in branches.items())
+        self.get_references().update(changes)
+
+    def update_references_file(self, commit_id, flow='commit'):
+        head = self.get_current_commit_id()
+        changes = {'HEAD': (head, commit_id)}
+        active_branch = self.get_active_branch()
+        if flow == 'commit' and active_branch and self.get_references().get(active_branch) == head:
+            # the active branch moves along with HEAD, other branches at the same commit stay
+            changes[active_branch] = (head, commit_id)
+        self.get_references().update(changes)
+
+    def get_branches(self):
+        if not os.path.exists(self.wit_references_file):
+            raise WitException('Cannot read reference file.')
+        self.branches = self.get_references_file_data()
+        self.branches.pop("HEAD")
+        return self.branches
+
+    def update_branches(self, branch_name):
+        if not os.path.exists(self.wit_references_file):
+            raise WitException('Cannot read reference file.')
+        head_commit_id = self.get_current_commit_id()
+        self.branches = self.get_branches()  # branches contain 'master'
+        if branch_name in self.branches:
+            raise WitException(
+                'Branch name "{}" already exists.'.format(branch_name))
+        self.get_references().update({branch_name: (None, head_commit_id)})
+        self.branches[branch_name] = head_commit_id
+
+    def create_active_branch_file(self, branch_name="master"):
+        with open(self.wit_active_branch_file, 'w') as fh:
+            fh.write(branch_name)
+
+    def get_active_branch(self):
+        with open(self.wit_active_branch_file, 'r') as fh:
+            active_branch = fh.readline()
+            return active_branch
+
+    def get_current_commit_id(self):
+        if os.path.exists(self.wit_references_file):
+            return self.get_references().get('HEAD')
+        logging.debug('No reference file exist')
+        return None
+
+    def get_graph_start_ids(self, show_all):
+        # HEAD, and every branch with show_all or master when HEAD is on it: {name: commit id}
+        head_commit_id = self.get_current_commit_id()
+        if head_commit_id is None:
+            return {}
+        start_ids = {'Head': head_commit_id}
+        self.branches = self.get_branches()
+        for branch, branch_commit_id in self.branches.items():
+            if show_all or (branch == 'master' and head_commit_id == branch_commit_id):
+                start_ids[branch] = branch_commit_id
+        return start_ids
+
+    def build_commit_history(self, show_all, max_count=None, since=None, is_collapsed=False):
+        ''' Parent edges of the newest commits, for generate_graph.
+        Args: max_count - most commits to take, since - timestamp of the oldest commit to take
+              is_collapsed - join linear chains of commits, which have one parent, one child
+                             and no reference, into one node
+        '''
+        start_ids = self.get_graph_start_ids(show_all)
+        commit_graph = self.get_commit_graph()
+        positions = list(islice(commit_graph.iter_topo_order(
+            [commit_graph.find(commit_id) for commit_id in start_ids.values()], since), max_count))
+        shown = set(positions)
+        references = set(start_ids.values())
+        children = defaultdict(list)
+        for position in positions:
+            for parent in commit_graph.get_record(position)[1]:
+                children[parent].append(position)
+        # topological order - a chain is met from its newest commit
+        chains = {}
+        for position in positions:
+            commit_id, parents, _, _ = commit_graph.get_record(position)
+            if is_collapsed and len(parents) == 1 and len(children[position]) == 1 and commit_id not in references:
+                child = children[position][0]
+                if child in chains:
+                    chains[position] = chains[child]
+                    chains[position].append(position)
+                else:
+                    chains[position] = [position]
+        node_names = {}
+        for position in positions:
+            chain = chains.get(position, [position])
+            if len(chain) == 1:
+                node_names[position] = commit_graph.get_commit_id(position)
+            else:
+                node_names[position] = '{}..{} ({} commits)'.format(commit_graph.get_commit_id(
+                    chain[0])[:7], commit_graph.get_commit_id(chain[-1])[:7], len(chain))
+        for name, commit_id in start_ids.items():
+            position = commit_graph.find(commit_id)
+            if position in shown:
+                self.commit_history[name].append(node_names[position])
+        for position in positions:
+            for parent in commit_graph.get_record(position)[1]:
+                if parent in shown and node_names[parent] != node_names[position]:
+                    self.commit_history[node_names[position]].append(node_names[parent])
+        return self.commit_history
+
+    def get_commit_file_data(self, filename):
+        return dict(line.rstrip().split('=', 1) for line in open(filename) if not line.startswith("#"))
+
+    def get_commit_graph(self):
+        if self.commit_graph is None:
+            if os.path.exists(self.wit_commit_graph_file):
+                self.commit_graph = CommitGraph(
+                    self.wit_commit_graph_file).load()
+            else:
+                self.commit_graph = self.build_commit_graph()
+        return self.commit_graph
+
+    @traced('build commit graph')
+    def build_commit_graph(self):
+        # commits made before the commit graph - index their metadata files once
+        commits = {}
+        if os.path.isdir(self.wit_images_dir):
+            for item in os.scandir(self.wit_images_dir):
+                if item.name.endswith('.txt'):
+                    data = self.get_commit_file_data(item.path)
+                    parents = [parent for parent in data.get(
+                        'parent', 'None').split(',') if parent != 'None']
+                    try:
+                        timestamp = int(datetime.strptime(
+                            data.get('date'), DATE_FORMAT).timestamp())
+                    except (TypeError, ValueError):
+                        timestamp = 0
+                    commits[item.name[:-len('.txt')]] = (parents, timestamp)
+        commit_graph = CommitGraph(self.wit_commit_graph_file).create()
+        added = set()
+        for commit_id in sorted(commits):
+            # parents must be written before their children
+            stack = [commit_id]
+            while stack:
+                item = stack[-1]
+                missing = [parent for parent in commits[item][0]
+                           if parent not in added and parent in commits]
+                if item in added:
+                    stack.pop()
+                elif missing:
+                    stack.extend(missing)
+                else:
+                    commit_graph.append(item, [parent for parent in commits[item][0] if parent in commits], commits[item][1])
+                    added.add(stack.pop())
+        return commit_graph
+
+    def create_commit_id_file(self, message, branch, tree_id):
+        ''' Write the metadata file of a new commit
+        Return: commit id - sha1 of the metadata, so the tree, parents, date and message
+        '''
+        if branch is None:
+            parent = self.get_current_commit_id()
+        else:
+            parent = '{},{}'.format(self.get_current_commit_id(), branch)
+        now = datetime.now(lazy_import('dateutil.tz').tzlocal())
+        data = "tree={}\nparent={}\ndate={}\nmessage={}\n".format(
+            tree_id, parent, now.strftime(DATE_FORMAT), message)
+        commit_id = hashlib.sha1(data.encode()).hexdigest()
+        with open(os.path.join(self.wit_images_dir, commit_id + '.txt'), 'w') as fh:
+            fh.write(data)
+        commit_graph = self.get_commit_graph()
+        # the same commit made twice within a second is the same commit
+        if commit_graph.find(commit_id) is None:
+            parent_ids = [item for item in str(parent).split(',') if item != 'None']
+            commit_graph.append(commit_id, parent_ids, int(now.timestamp()))
+            # record the changed paths now, while the trees were just written
+            self.get_path_filters()
+        return commit_id
+
+    def get_path_filters(self):
+        ''' Changed path filters of every commit in the commit graph, the missing ones are made first,
+        e.g. of commits made before the filters
+        '''
+        commit_graph = self.get_commit_graph()
+        if self.path_filters is None:
+            self.path_filters = ChangedPathFilters(self.wit_commit_graph_file).load()
+        if len(self.path_filters) < len(commit_graph):
+            with trace_span('write path filters'):
+                self.path_filters.append(self.get_changed_path_filter(position)
+                                         for position in range(len(self.path_filters), len(commit_graph)))
+        return self.path_filters
+
+    def get_changed_path_filter(self, position):
+        commit_graph = self.get_commit_graph()
+        commit_id, parents, _, _ = commit_graph.get_record(position)
+        parent_tree_id = self.get_commit_tree_id(commit_graph.get_commit_id(parents[0])) if parents else None
+        changes = self.objects.iter_tree_diff(parent_tree_id, self.get_commit_tree_id(commit_id))
+        return make_path_filter(path for path, _, _ in changes)
+
+    def get_commit_tree_id(self, commit_id):
+        commit_file = os.path.join(self.wit_images_dir, commit_id + '.txt')
+        tree_id = self.get_commit_file_data(commit_file).get('tree')
+        if tree_id is None:
+            # commit made before the object store - import its image folder once
+            tree_id = self.objects.write_tree(
+                os.path.join(self.wit_images_dir, commit_id))
+            with open(commit_file, 'a') as fh:
+                fh.write('tree={}\n'.format(tree_id))
+        return tree_id
+
+    def iter_commit_files(self, commit_id):
+        # (relative path, blob id) of the commit in path parts order
+        if commit_id is None:
+            return iter(())
+        return ((path, blob_id) for path, _, blob_id in self.objects.iter_tree_files(self.get_commit_tree_id(commit_id)))
+
+    @traced('load index')
+    def load_index(self):
+        index = Index(self.wit_index_file)
+        if not os.path.exists(self.wit_index_file) and os.path.isdir(self.wit_staging_dir):
+            # staging area folder made before the index - import it once
+            file_paths = [os.path.join(path, filename) for path, _, filenames in os.walk(
+                self.wit_staging_dir) for filename in filenames]
+            for file_path, blob_id in zip(file_paths, self.objects.write_blobs(file_paths)):
+                index.set_entry(os.path.relpath(
+                    file_path, self.wit_staging_dir), get_file_mode(file_path), blob_id)
+            index.save()
+            shutil.rmtree(self.wit_staging_dir)
+        return index
+
+    def expand_commit_id(self, commit_id):
+        ''' Full commit id from a full or abbreviated commit id
+        Raises: WitException if no commit or more than one commit starts with it
+        Return: valid commit id
+        '''
+        prefix = str(commit_id).lower()
+        if len(prefix) < MIN_ABBREV or prefix.strip(string.hexdigits):
+            raise WitException('Commit ID was not found: {}'.format(commit_id))
+        commit_graph = self.get_commit_graph()
+        matches = commit_graph.find_prefix(prefix)
+        if not matches:
+            raise WitException('Commit ID was not found: {}'.format(commit_id))
+        if len(matches) > 1:
+            raise WitException('Commit ID is ambiguous: {}'.format(commit_id))
+        return commit_graph.get_commit_id(matches[0])
+
+    def resolve_commit_id(self, name):
+        ''' Commit id of a branch name, 'HEAD' or commit id, without changing the active branch.
+        Raises: WitException if no such commit
+        '''
+        commit_id = name
+        if os.path.exists(self.wit_references_file):
+            commit_id = self.get_references_file_data().get(name, name)
+        return self.expand_commit_id(commit_id)
+
+    def get_actual_commit_id_from_input(self, checkout_input):
+        ''' Parsing checkout input to actual commit_id, the active branch is left as is
+        Args: checkout_input - could be either branch name (including 'master' branch) or full or abbreviated commit id
+        Raises: WitException if references files does not exist or if commit id was not found or is ambiguous
+        Return: (valid commit id, branch name to activate - "" for a commit id)
+        '''
+        branch_name = ""
+        actual_commit_id = checkout_input
+        if checkout_input in self.get_branches():
+            if not os.path.exists(self.wit_references_file):
+                raise WitException('Cannot read reference file.')
+            actual_commit_id = self.get_references_file_data().get(checkout_input)
+            branch_name = checkout_input
+        actual_commit_id = self.expand_commit_id(actual_commit_id)
+        logging.warning('==> checkout {}'.format(actual_commit_id))
+        return actual_commit_id, branch_name
+
+    def generate_graph(self):
+        self.branches = self.get_branches()
+        active_branch = self.get_active_branch()
+        data = self.commit_history
+        graph = lazy_import('graphviz').Digraph(name='wit_graph')
+        for k, v in data.items():
+            for item in v:
+                graph.edge(k, item)
+                if k in self.branches:
+                    graph.node(k, shape="plaintext")
+                    if k == active_branch:
+                        graph.node(k, label="{}*".format(k))
+        graph.graph_attr['rankdir'] = 'LR'
+        graph.edge_attr.update(arrowhead='vee', arrowsize='2')
+        graph.node('Head', shape="plaintext")
+        print(graph.source)
+        graph.view()
+
+    def before_merge(self, branch_name, head_commit_id):
+        # if branch and head are same -> nothing to do
+        self.branches = self.get_branches()
+        if branch_name not in self.branches:
+            raise WitException('Branch "{}" not found.'.format(branch_name))
+        branch_commit_id = self.branches.get(branch_name)
+        if head_commit_id == branch_commit_id:
+            raise WitException(
+                '"HEAD" and branch "{}" are the same -> do nothing.'.format(branch_name))
+        return branch_commit_id
+
+    def get_merge_base_tree_id(self, first_commit_id, second_commit_id):
+        ''' Tree of the best common ancestor of two commits.
+        With several merge bases (criss-cross history) they are merged into one virtual base tree.
+        Return: tree object id, None if the commits share no history
+        '''
+        commit_graph = self.get_commit_graph()
+        bases = commit_graph.get_merge_bases(commit_graph.find(
+            first_commit_id), commit_graph.find(second_commit_id))
+        if not bases:
+            return None
+        base_ids = [commit_graph.get_commit_id(item) for item in bases]
+        logging.debug('merge base: {}'.format(', '.join(base_ids)))
+        tree_id = self.get_commit_tree_id(base_ids[0])
+        for other_id in base_ids[1:]:
+            inner_base_tree_id = self.get_merge_base_tree_id(
+                base_ids[0], other_id)
+            changes, _ = merge_tree_changes(
+                self.objects, inner_base_tree_id, tree_id, self.get_commit_tree_id(other_id))
+            files = {path: (mode, blob_id) for path, mode,
+                     blob_id in self.objects.iter_tree_files(tree_id)}
+            for path, _, new_blob in changes:
+                if new_blob is None:
+                    files.pop(path, None)
+                else:
+                    files[path] = new_blob
+            tree_id = self.objects.write_tree_from_files(
+                sorted(files.items(), key=lambda item: item[0].split(os.sep)))
+        return tree_id
+
+    def handle_merge_branch(self, branch_name):
+        head_commit_id = self.get_current_commit_id()
+        branch_commit_id = self.before_merge(branch_name, head_commit_id)
+        index = self.load_index()
+        if has_uncommitted_changes(self, index, head_commit_id):
+            raise WitException('Uncommitted work found, blocking merge')
+        # find the common ancestor of head & branch
+        commit_graph = self.get_commit_graph()
+        if commit_graph.is_ancestor(commit_graph.find(branch_commit_id), commit_graph.find(head_commit_id)):
+            print('Already up to date.')
+            return
+        with trace_span('merge base'):
+            base_tree_id = self.get_merge_base_tree_id(
+                head_commit_id, branch_commit_id)
+        # apply only the changes made on the branch since the common ancestor
+        with trace_span('merge trees'):
+            changes, conflicts = merge_tree_changes(self.objects, base_tree_id, self.get_commit_tree_id(
+                head_commit_id), self.get_commit_tree_id(branch_commit_id))
+        # files changed on both sides - merge their content line by line
+        conflicted_files = []
+        for path, base_blob, our_blob, their_blob in conflicts:
+            merged_file, is_conflicted = self.merge_file(
+                base_blob, our_blob, their_blob, branch_name)
+            if merged_file is None:
+                logging.warning(
+                    'Merge conflict in {}, taking branch version.'.format(path))
+                changes.append((path, our_blob, their_blob))
+            elif is_conflicted:
+                conflicted_files.append((path, merged_file))
+            else:
+                mode = pick_merge_mode(base_blob, our_blob, their_blob)
+                changes.append(
+                    (path, our_blob, (mode, self.objects.write_blob(merged_file))))
+                os.remove(merged_file)
+        apply_changes(self, index, changes, self.get_sparse_patterns())
+        index.save()
+        if conflicted_files:
+            # leave conflicted files unstaged, the next commit completes the merge
+            for path, merged_file in conflicted_files:
+                logging.warning('Merge conflict in {}'.format(path))
+                # written even outside the sparse checkout, the conflict has to be fixed
+                os.makedirs(os.path.dirname(os.path.join(self.wit_root_path, path)), exist_ok=True)
+                os.replace(merged_file, os.path.join(self.wit_root_path, path))
+            with open(self.wit_merge_head_file, 'w') as fh:
+                fh.write(branch_commit_id)
+            print('Automatic merge failed; fix conflicts, add them and commit the result.')
+            return
+        # execute commit with the changes in staging
+        commit(['merge "{}"'.format(branch_name)], branch_commit_id)
+
+    @traced('merge file')
+    def merge_file(self, base_blob, our_blob, their_blob, branch_name):
+        ''' Three way merge of text file content into a temporary file.
+        Return: (merged file path, has conflict markers), (None, True) when there is no text merge - binary or deleted file
+        '''
+        if our_blob is None or their_blob is None:
+            return None, True
+        paths = [None if blob is None else self.objects.get_object_file(blob[1])
+                 for blob in (base_blob, our_blob, their_blob)]
+        if any(path is not None and is_binary_file(path) for path in paths):
+            return None, True
+        fd, merged_file = make_temp_file(self.wit_dir)
+        with os.fdopen(fd, 'wb') as fh:
+            is_conflicted = merge_line_files(LineFile(paths[0]), LineFile(paths[1]), LineFile(
+                paths[2]), fh, b'HEAD', branch_name.encode())
+        return merged_file, is_conflicted
+
+
+def detect_changes(f):
+    def are_changes_exist(jobs):
+        try:
+            wit = WitRepo(os.getcwd(), jobs)
+            wit.validate_repo_at_path(os.getcwd(), True)
+        except WitException:
+            return
+        last_commit_id = wit.get_current_commit_id()
+        if last_commit_id is None:
+            return True
+        # stop on the first staged change
+        return any(iter_staged_changes(wit.load_index().iter_blobs(), wit.iter_commit_files(last_commit_id)))
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with trace_span('detect changes'):
+            changes_exist = are_changes_exist(kwargs.get('jobs', 1))
+        if not changes_exist:
+            logging.error('No changes detected in staging to be committed.')
+            return
+        return f(*args, **kwargs)
+    return decorated
+
+
+def make_folders(root_dir, subfolders):
+    concat_path = partial(os.path.join, root_dir)
+    for path in map(concat_path, subfolders):
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError as err:
+            logging.error("Directory {} can not be created".format(path))
+            raise err
+
+
+def init(args):
+    ''' Initialize wit work folders.
+    Args: None
+    Raises: OSError in case folder creation is failing.
+    Return: None
+    Assumption - if folders exists don't do anything.
+    '''
+    wit = WitRepo(os.getcwd())
+    wit_dir = wit.wit_dir
+    subfolders = ('images', 'objects')
+    make_folders(wit_dir, subfolders)
+    if not os.path.exists(wit.wit_index_file):
+        Index(wit.wit_index_file).save()
+    wit.create_active_branch_file()
+
+
+def add_files_to_index(wit, index, file_paths):
+    to_store = []
+    for file_path in file_paths:
+        relative_path = os.path.relpath(file_path, wit.wit_root_path)
+        stat_result = os.stat(file_path)
+        if relative_path in index and index.is_up_to_date(relative_path, stat_result):
+            continue
+        to_store.append((relative_path, file_path, stat_result))
+    # hash and copy in parallel, then update the index in a fixed order
+    blob_ids = wit.objects.write_blobs([item[1] for item in to_store])
+    for (relative_path, file_path, stat_result), blob_id in zip(to_store, blob_ids):
+        index.set_entry(relative_path, get_file_mode(
+            file_path), blob_id, stat_result)
+
+
+@traced('walk')
+def list_folder_files(wit, index, root_folder, sparse):
+    # files under a folder to add, ignored folders are not entered unless they hold tracked files
+    file_paths = []
+    ignore = wit.get_ignore_matcher()
+    for path, folders, filenames in os.walk(root_folder):
+        if '.wit' in folders:
+            folders.remove('.wit')
+        relative_root = os.path.relpath(path, wit.wit_root_path)
+        relative_root = '' if relative_root == '.' else relative_root
+        ignore.load(relative_root, IGNORE_FILE in filenames)
+        folders[:] = [folder for folder in folders if index.is_folder(os.path.join(relative_root, folder))
+                      or not ignore.is_ignored(os.path.join(relative_root, folder), True)]
+        if sparse is not None:
+            # folders outside the sparse checkout are not entered
+            folders[:] = [folder for folder in folders if sparse.is_walked(os.path.join(relative_root, folder))]
+        folders.sort()
+        for filename in sorted(filenames):
+            relative_path = os.path.join(relative_root, filename)
+            if relative_path in index or not ignore.is_ignored(relative_path):
+                file_paths.append(os.path.join(path, filename))
+    return file_paths
+
+
+def handle_path_addition(wit, path_item):
+    realpath = os.path.realpath(path_item)
+    index = wit.load_index()
+    sparse = wit.get_sparse_patterns()
+    if os.path.isfile(realpath):
+        file_paths = [realpath]
+    else:
+        file_paths = list_folder_files(wit, index, realpath, sparse)
+    if sparse is not None:
+        inside = [path for path in file_paths if sparse.matches(os.path.relpath(path, wit.wit_root_path))]
+        if len(inside) < len(file_paths):
+            logging.warning('{} paths outside the sparse checkout are not added.'.format(len(file_paths) - len(inside)))
+        file_paths = inside
+    add_files_to_index(wit, index, file_paths)
+    if index.is_changed:
+        index.save()
+
+
+def add(paths: List[str], jobs=1):
+    # Check whether the path is valid and is under wit repo
+    for path_item in paths:
+        if not os.path.exists(path_item):
+            logging.error(
+                'Path "{}" did not match any files'.format(path_item))
+            return
+        try:
+            wit = WitRepo(os.getcwd(), jobs)
+            wit.validate_repo_at_path(path_item, True)
+        except WitException:
+            return
+        handle_path_addition(wit, path_item)
+
+
+@detect_changes
+def commit(message, branch=None, jobs=1):
+    message = message[0]
+    try:
+        wit = WitRepo(os.getcwd(), jobs)
+        wit.validate_repo_at_path(os.getcwd(), True)
+    except WitException:
+        return
+    # Part I - save staging tree, files were already stored by 'add'
+    with trace_span('write tree'):
+        tree_id = wit.objects.write_tree_from_files(
+            wit.load_index().iter_tree_files())
+    # Part II - generate ID and create metadata file
+    with trace_span('write commit'):
+        if branch is None and os.path.exists(wit.wit_merge_head_file):
+            # completing a merge which stopped on conflicts
+            with open(wit.wit_merge_head_file) as fh:
+                branch = fh.read().strip()
+        commit_id = wit.create_commit_id_file(message, branch, tree_id)
+        if os.path.exists(wit.wit_merge_head_file):
+            os.remove(wit.wit_merge_head_file)
+    # Part III - manage reference data
+    ref_path = wit.wit_references_file
+    try:
+        with trace_span('update references'):
+            if os.path.exists(ref_path):
+                wit.update_references_file(commit_id)
+            else:
+                wit.create_references_file(commit_id, commit_id, wit.branches)
+    except WitException:
+        return
+
+
+def iter_path_join(left, right):
+    ''' Merge two iterables of (relative path, value), both in path parts order, without loading either.
+    Return: generator of (relative path, left value or None, right value or None) in path parts order
+    '''
+    left = ((path.split(os.sep), path, value) for path, value in left)
+    right = ((path.split(os.sep), path, value) for path, value in right)
+    left_item, right_item = next(left, None), next(right, None)
+    while left_item is not None or right_item is not None:
+        if right_item is None or (left_item is not None and left_item[0] < right_item[0]):
+            yield left_item[1], left_item[2], None
+            left_item = next(left, None)
+        elif left_item is None or right_item[0] < left_item[0]:
+            yield right_item[1], None, right_item[2]
+            right_item = next(right, None)
+        else:
+            yield left_item[1], left_item[2], right_item[2]
+            left_item, right_item = next(left, None), next(right, None)
+
+
+def iter_staged_changes(staged_files, last_commit_files):
+    # Compare content of staging area to the files stored for last commit, both (path, blob id) in path parts order
+    for path, staged_blob_id, commit_blob_id in iter_path_join(staged_files, last_commit_files):
+        if commit_blob_id is None:
+            yield path, Changes.NEW
+        elif staged_blob_id is None:
+            yield path, Changes.DELETED
+        elif staged_blob_id != commit_blob_id:
+            yield path, Changes.MODIFIED
+
+
+def iter_working_tree_changes(workdir, index, sparse=None, ignore=None):
+    ''' Compare working directory to the index in a single scandir walk.
+    Only files whose stat data changed since they were indexed are hashed, untracked folders are not entered.
+    Args: workdir - repository root folder, index - loaded Index, refreshed in place
+          sparse - SparsePatterns, other paths are neither walked nor compared
+          ignore - IgnoreMatcher, untracked paths it ignores are skipped
+    Return: generator of (relative path, Changes kind) in path order, stop consuming it to stop the walk
+    '''
+    return iter_folder_changes(workdir, index, '', sparse=sparse, ignore=ignore)
+
+
+def scan_working_tree(workdir, index, sparse=None, ignore=None, jobs=1):
+    ''' iter_working_tree_changes with many folders read and files stat'ed at once, for file systems
+    where every call waits for a round trip, e.g. NFS.
+    Args: jobs - folders scanned at once, and stat calls at once, 0 for one per CPU
+    Return: list of (relative path, Changes kind), the same list in the same order as iter_working_tree_changes
+    '''
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    futures = lazy_import('concurrent.futures')
+    changes = []
+    # futures of every folder, a folder's future is added before the scan which found it ends
+    scans = []
+    # folder workers wait for the stat workers, which never wait - no deadlock
+    with futures.ThreadPoolExecutor(max_workers=jobs) as folder_executor, \
+            futures.ThreadPoolExecutor(max_workers=jobs) as stat_executor:
+        def submit(folder):
+            scans.append(folder_executor.submit(scan, folder))
+
+        def scan(folder):
+            # a tracked sub folder is queued as soon as it is found, while this folder is still scanned
+            return list(iter_folder_changes(workdir, index, folder, SimpleNamespace(append=submit),
+                                            sparse, ignore, stat_executor.map))
+        submit('')
+        done = 0
+        while done < len(scans):
+            changes.extend(scans[done].result())
+            done += 1
+    # same order as a walk of the tree
+    return sorted(changes, key=lambda change: change[0].split(os.sep))
+
+
+def iter_folder_changes(workdir, index, relative_root, subfolders=None, sparse=None, ignore=None,
+                        stat_map=None):
+    ''' Args: subfolders - list, or any object with append, to collect the tracked sub folders in instead of walking them
+              stat_map - map function to stat the tracked files of the folder at once, e.g. Executor.map
+    '''
+    if sparse is not None and sparse.matches(relative_root):
+        # everything under a matching folder matches
+        sparse = None
+    tracked = index.get_folder(relative_root)
+    with os.scandir(os.path.join(workdir, relative_root)) as dir_content:
+        items = {item.name: item for item in dir_content}
+    if relative_root == '':
+        items.pop('.wit', None)
+    if ignore is not None and relative_root not in ignore.rules:
+        ignore.load(relative_root, IGNORE_FILE in items)
+    if stat_map is not None:
+        # a DirEntry keeps its stat result, the loop below finds it ready
+        files = [items[name] for name, is_folder in tracked.items() if is_folder is False and name in items]
+        list(stat_map(os.DirEntry.stat, files))
+    for name in sorted(items.keys() | tracked.keys()):
+        relative_path = os.path.join(relative_root, name)
+        item = items.get(name)
+        is_tracked_folder = tracked.get(name) is True
+        is_tracked_file = tracked.get(name) is False
+        if sparse is not None:
+            is_folder = is_tracked_folder or (item is not None and item.is_dir())
+            if not (sparse.is_walked(relative_path) if is_folder else sparse.matches(relative_path)):
+                continue
+        if item is not None and item.is_dir():
+            if is_tracked_folder:
+                if subfolders is None:
+                    yield from iter_folder_changes(workdir, index, relative_path, sparse=sparse, ignore=ignore)
+                else:
+                    subfolders.append(relative_path)
+                continue
+            if is_tracked_file:
+                yield relative_path, Changes.DELETED
+            if ignore is None or not ignore.is_ignored(relative_path, True):
+                yield relative_path, Changes.UNTRACKED
+        elif item is not None and is_tracked_file:
+            trace_count('files_stat')
+            stat_result = item.stat()
+            if index.is_up_to_date(relative_path, stat_result):
+                continue
+            if hash_file(item.path) == index[relative_path].blob_id:
+                index.refresh_entry(relative_path, stat_result)
+            else:
+                yield relative_path, Changes.MODIFIED
+        else:
+            if is_tracked_folder:
+                for path, _ in index.items(relative_path):
+                    if sparse is None or sparse.matches(path):
+                        yield path, Changes.DELETED
+            elif is_tracked_file:
+                yield relative_path, Changes.DELETED
+            if item is not None and (ignore is None or not ignore.is_ignored(relative_path)):
+                yield relative_path, Changes.UNTRACKED
+
+
+def get_changes_to_be_committed(staged_changes, required=True):
+    colors = {Changes.NEW: 'green',
+              Changes.MODIFIED: 'yellow', Changes.DELETED: 'red'}
+    if len(staged_changes) == 0:
+        if required:
+            return '\tNo changes detected\n'
+        return False
+    if required:
+        return '\n'.join(colored('\t{}:\t{}'.format(kind, item), colors[kind]) for item, kind in staged_changes) + '\n'
+    return True
+
+
+def get_changes_not_committed(workdir, working_tree_changes, required=True, cwd=None):
+    # Working directory changes of files which are in the staging area
+    colors = {Changes.MODIFIED: 'yellow', Changes.DELETED: 'red'}
+    printable_changes = [colored('\t{}:\t{}'.format(kind, os.path.relpath(os.path.join(
+        workdir, item), cwd or os.getcwd())), colors[kind]) for item, kind in working_tree_changes if kind != Changes.UNTRACKED]
+    if len(printable_changes) == 0:
+        if required:
+            return '\tNo changes detected\n'
+        return False
+    if required:
+        return '\n'.join(printable_changes) + '\n'
+    return True
+
+
+def get_untracked_files(workdir, working_tree_changes, cwd=None):
+    # New files in the working directory which are not in staging
+    printable_new_files = (colored('\t' + os.path.relpath(os.path.join(
+        workdir, item), cwd or os.getcwd()), 'red') for item, kind in working_tree_changes if kind == Changes.UNTRACKED)
+    return '\n'.join(printable_new_files)
+
+
+def get_status_report(workdir, last_commit_id, staged_changes, working_tree_changes, cwd):
+    if last_commit_id is None:
+        return 'No commits yet\n\nChanges to be committed:\n{}\nChanges not staged for commit:\n{}\nUntracked files:\n{}\n'.format(
+            get_changes_to_be_committed(staged_changes), get_changes_not_committed(workdir, working_tree_changes, cwd=cwd), get_untracked_files(workdir, working_tree_changes, cwd))
+    return 'Current commit ID: {}\nChanges to be committed:\n{}\nChanges not staged for commit:\n{}\nUntracked files:\n{}\n'.format(
+        last_commit_id, get_changes_to_be_committed(staged_changes), get_changes_not_committed(workdir, working_tree_changes, cwd=cwd), get_untracked_files(workdir, working_tree_changes, cwd))
+
+
+def status(jobs=1):
+    try:
+        wit = WitRepo(os.getcwd())
+        wit.validate_repo_at_path(os.getcwd(), True)
+    except WitException:
+        return
+    with trace_span('daemon request'):
+        reply = request_daemon(wit.wit_dir, '{} {}'.format(Commends.STATUS, os.getcwd()))
+    if reply is not None:
+        print(reply)
+        return
+    index = wit.load_index()
+    workdir = wit.wit_root_path
+    with trace_span('scan working tree'):
+        if jobs == 1:
+            working_tree_changes = list(iter_working_tree_changes(
+                workdir, index, wit.get_sparse_patterns(), wit.get_ignore_matcher()))
+        else:
+            working_tree_changes = scan_working_tree(
+                workdir, index, wit.get_sparse_patterns(), wit.get_ignore_matcher(), jobs)
+    if index.is_changed:
+        index.save()
+    last_commit_id = wit.get_current_commit_id()
+    with trace_span('staged changes'):
+        staged_changes = list(iter_staged_changes(
+            index.iter_blobs(), wit.iter_commit_files(last_commit_id)))
+    print(get_status_report(workdir, last_commit_id,
+                            staged_changes, working_tree_changes, os.getcwd()))
+
+
+def request_daemon(wit_dir, request):
+    ''' Send one request line to the wit daemon of a repository.
+    Return: the reply, None when no daemon answers
+    '''
+    socket_file = os.path.join(wit_dir, DAEMON_SOCKET)
+    if not os.path.exists(socket_file):
+        return None
+    socket = lazy_import('socket')
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(DAEMON_TIMEOUT)
+            client.connect(socket_file)
+            client.sendall((request + '\n').encode())
+            # a daemon which failed to answer closes the connection without a reply
+            return b''.join(iter(partial(client.recv, CHUNK_SIZE), b'')).decode() or None
+    except OSError:
+        return None
+
+
+class Inotify:
+    ''' Linux inotify(7) through ctypes.
+    Raises: OSError where it is not available
+    '''
+    EVENT = struct.Struct('iIII')
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self) -> None:
+        self.ctypes = lazy_import('ctypes')
+        try:
+            self.libc = self.ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, TypeError) as e:
+            raise OSError(str(e))
+        if self.fd < 0:
+            raise OSError(self.ctypes.get_errno(), os.strerror(self.ctypes.get_errno()))
+
+    def add_watch(self, path):
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if watch < 0:
+            raise OSError(self.ctypes.get_errno(), os.strerror(self.ctypes.get_errno()), path)
+        return watch
+
+    def close(self):
+        os.close(self.fd)
+
+    def read_events(self):
+        ''' Return: list of (watch descriptor, event mask, file name) queued so far '''
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                watch, mask, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                events.append((watch, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+                offset += length
+
+
+class StatusDaemon:
+    ''' Answers status requests of one repository on .wit/daemon.sock from memory.
+    The index, references and last commit files stay loaded. inotify watches .wit and the tracked
+    folders: a changed folder is scanned again without its sub folders, a changed index or
+    references file is read again. Without inotify, or past the inotify watch limit, every
+    request scans the whole tree.
+    Requests are one line - "status <client working directory>", "ping" or "stop".
+    A failed request is logged and closed without a reply, the client then runs status itself.
+    '''
+
+    def __init__(self, wit) -> None:
+        self.wit = wit
+        self.workdir = str(wit.wit_root_path)
+        self.socket_file = os.path.join(wit.wit_dir, DAEMON_SOCKET)
+        # watch descriptor: folder relative path, None for .wit
+        self.watches = {}
+        # folder relative path: (changes of the folder entries, tracked sub folders)
+        self.folders = {}
+        self.dirty = set()
+        self.staged_changes = None
+        self.selector = None
+        try:
+            self.inotify = Inotify()
+            self.watches[self.inotify.add_watch(wit.wit_dir)] = None
+        except OSError:
+            logging.warning('inotify is not available, every status request scans the working directory.')
+            self.inotify = None
+        self.load_index()
+
+    def load_index(self):
+        self.index = self.wit.load_index()
+        self.sparse = self.wit.get_sparse_patterns()
+        self.ignore = self.wit.get_ignore_matcher()
+        self.folders.clear()
+        self.staged_changes = None
+
+    def apply_events(self):
+        if self.inotify is None:
+            self.wit.references = None
+            self.load_index()
+            return
+        for watch, mask, name in self.inotify.read_events():
+            folder = self.watches.get(watch, '')
+            if mask & IN_Q_OVERFLOW:
+                self.wit.references = None
+                self.load_index()
+            elif mask & IN_IGNORED:
+                # folder removed, its parent was changed too
+                self.watches.pop(watch, None)
+                self.folders.pop(folder, None)
+            elif folder is not None and name == IGNORE_FILE:
+                # may change what is ignored in every folder under it
+                self.ignore = self.wit.get_ignore_matcher()
+                self.folders.clear()
+            elif folder is not None:
+                self.dirty.add(folder)
+            elif name in (os.path.basename(self.wit.wit_index_file), os.path.basename(self.wit.wit_sparse_file)):
+                self.load_index()
+            elif name in (os.path.basename(self.wit.wit_references_file), os.path.basename(self.wit.wit_packed_refs_file)):
+                self.wit.references = None
+                self.staged_changes = None
+
+    def stop_watching(self):
+        # from here on every request scans the working directory
+        if self.selector is not None:
+            self.selector.unregister(self.inotify.fd)
+        self.inotify.close()
+        self.inotify = None
+        self.watches.clear()
+
+    def watch(self, folder):
+        try:
+            self.watches[self.inotify.add_watch(os.path.join(self.workdir, folder))] = folder
+        except FileNotFoundError:
+            raise
+        except OSError as e:
+            # ENOSPC once fs.inotify.max_user_watches folders are watched
+            logging.warning('inotify cannot watch {} ({}), every status request scans the working directory.'.format(
+                folder or '.', e.strerror))
+            self.stop_watching()
+
+    def scan(self, folder):
+        subfolders = []
+        try:
+            if self.inotify is not None:
+                # watch first, a change during the scan is seen by the next request
+                self.watch(folder)
+            changes = list(iter_folder_changes(
+                self.workdir, self.index, folder, subfolders, self.sparse, self.ignore))
+        except FileNotFoundError:
+            changes, subfolders = [], []
+        self.folders[folder] = (changes, subfolders)
+
+    def get_working_tree_changes(self):
+        for folder in self.dirty:
+            self.folders.pop(folder, None)
+        self.dirty.clear()
+        working_tree_changes = []
+        folders = ['']
+        while folders:
+            folder = folders.pop()
+            if folder not in self.folders:
+                self.scan(folder)
+            changes, subfolders = self.folders[folder]
+            working_tree_changes.extend(changes)
+            folders.extend(subfolders)
+        # same order as a walk of the tree
+        return sorted(working_tree_changes, key=lambda change: change[0].split(os.sep))
+
+    def get_status(self, cwd):
+        self.apply_events()
+        working_tree_changes = self.get_working_tree_changes()
+        last_commit_id = self.wit.get_current_commit_id()
+        if self.staged_changes is None:
+            self.staged_changes = list(iter_staged_changes(
+                self.index.iter_blobs(), self.wit.iter_commit_files(last_commit_id)))
+        return get_status_report(self.workdir, last_commit_id, self.staged_changes, working_tree_changes, cwd)
+
+    def handle(self, connection):
+        ''' Return: False to stop the daemon '''
+        command = None
+        with connection:
+            try:
+                # a client which sends no request line must not keep the others waiting
+                connection.settimeout(DAEMON_TIMEOUT)
+                request = connection.makefile('rb').readline().decode().rstrip('\n')
+                command, _, argument = request.partition(' ')
+                if command == Commends.STATUS:
+                    reply = self.get_status(argument)
+                elif command == 'ping':
+                    reply = 'pong'
+                elif command == 'stop':
+                    reply = 'wit daemon stopped'
+                else:
+                    reply = 'unknown request: {}'.format(command)
+                connection.sendall(reply.encode())
+            except OSError as e:
+                logging.warning('wit daemon request {} failed: {}'.format(command, e))
+            except Exception as e:
+                logging.error('wit daemon request {} failed: {!r}'.format(command, e))
+                # the loaded state may be the cause, the next request reads it again
+                self.wit.references = None
+                self.load_index()
+        return command != 'stop'
+
+    def serve(self):
+        socket, selectors = lazy_import('socket'), lazy_import('selectors')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_file)
+        server.listen()
+        selector = self.selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        if self.inotify is not None:
+            selector.register(self.inotify.fd, selectors.EVENT_READ)
+        self.get_working_tree_changes()
+        try:
+            while True:
+                for key, _ in selector.select():
+                    if key.fileobj is server:
+                        if not self.handle(server.accept()[0]):
+                            return
+                    elif self.inotify is not None:
+                        self.apply_events()
+        finally:
+            self.selector = None
+            selector.close()
+            server.close()
+            os.remove(self.socket_file)
+
+
+def daemon(stop):
+    try:
+        wit = WitRepo(os.getcwd())
+        wit.validate_repo_at_path(os.getcwd(), True)
+    except WitException:
+        return
+    if stop:
+        reply = request_daemon(wit.wit_dir, 'stop')
+        print(reply if reply is not None else 'No wit daemon is running.')
+        return
+    if not hasattr(lazy_import('socket'), 'AF_UNIX'):
+        logging.error('wit daemon needs Unix domain sockets.')
+        return
+    if request_daemon(wit.wit_dir, 'ping') is not None:
+        logging.error('A wit daemon is already running for this repository.')
+        return
+    socket_file = os.path.join(wit.wit_dir, DAEMON_SOCKET)
+    if os.path.exists(socket_file):
+        # left by a daemon which did not stop cleanly
+        os.remove(socket_file)
+    print('wit daemon listening on {}'.format(socket_file))
+    try:
+        StatusDaemon(wit).serve()
+    except KeyboardInterrupt:
+        pass
+
+
+def handle_path_removal(wit, path_item):
+    relative_path = os.path.relpath(
+        os.path.realpath(path_item), wit.wit_root_path)
+    index = wit.load_index()
+    removed = index.remove_entries(relative_path)
+    if not removed:
+        logging.error('File to delete from staging was not there.')
+        return
+    if removed == [relative_path]:
+        print('deleting file: {}'.format(relative_path))
+    else:
+        print('deleting folder: {}'.format(relative_path))
+    index.save()
+
+
+def rm(paths):
+    # Check whether the path is valid and is under wit repo
+    for path_item in paths:
+        if not os.path.exists(path_item):
+            logging.error(
+                'Path "{}" did not match any files'.format(path_item))
+            return
+        try:
+            wit = WitRepo(os.getcwd())
+            wit.validate_repo_at_path(path_item, True)
+        except WitException:
+            return
+        handle_path_removal(wit, path_item)
+
+
+def remove_working_file(workdir, relative_path):
+    file_path = os.path.join(workdir, relative_path)
+    if os.path.isfile(file_path) or os.path.islink(file_path):
+        os.remove(file_path)
+    # remove the folders left empty
+    parent = os.path.dirname(relative_path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(workdir, parent))
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+class LineFile:
+    ''' Hash and offset of every line of a file.
+    The file is read in chunks and its lines are never kept in memory, line content is copied
+    straight from the file when writing a merge result.
+    '''
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.hashes = array('q')
+        self.offsets = array('Q', [0])
+        self.ends_with_newline = True
+        if path is None:
+            return
+        offset = 0
+        rest = b''
+        with open(path, 'rb') as fh:
+            for chunk in iter(partial(fh.read, CHUNK_SIZE), b''):
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    offset += len(line) + 1
+                    self.hashes.append(hash((line, True)))
+                    self.offsets.append(offset)
+        if rest:
+            self.hashes.append(hash((rest, False)))
+            self.offsets.append(offset + len(rest))
+            self.ends_with_newline = False
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def copy_lines(self, start, end, out_fh, is_line_closed=False):
+        # is_line_closed - end the last line with a newline even if the file doesn't
+        if start >= end:
+            return
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offsets[start])
+            remaining = self.offsets[end] - self.offsets[start]
+            while remaining:
+                chunk = fh.read(min(CHUNK_SIZE, remaining))
+                out_fh.write(chunk)
+                remaining -= len(chunk)
+        if is_line_closed and end == len(self) and not self.ends_with_newline:
+            out_fh.write(b'\n')
+
+    def read_bytes(self, start, end):
+        if start >= end:
+            return b''
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offsets[start])
+            return fh.read(self.offsets[end] - self.offsets[start])
+
+    def iter_different_lines(self, start, other, other_start, count):
+        ''' Lines taken as equal by their hashes whose bytes differ, a hash collision.
+        Blocks of lines are compared at once, lines one by one only in a block which differs.
+        Return: generator of line numbers from start and other_start
+        '''
+        for block in range(0, count, LINE_BLOCK):
+            size = min(LINE_BLOCK, count - block)
+            data = self.read_bytes(start + block, start + block + size)
+            other_data = other.read_bytes(other_start + block, other_start + block + size)
+            if data == other_data:
+                continue
+            base, other_base = self.offsets[start + block], other.offsets[other_start + block]
+            for number in range(block, block + size):
+                line = data[self.offsets[start + number] - base:self.offsets[start + number + 1] - base]
+                other_line = other_data[other.offsets[other_start + number] - other_base:
+                                        other.offsets[other_start + number + 1] - other_base]
+                if line != other_line:
+                    yield number
+
+    def read_lines(self, start, end):
+        if start >= end:
+            return []
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offsets[start])
+            data = fh.read(self.offsets[end] - self.offsets[start])
+        lines = data.split(b'\n')
+        if lines[-1] == b'':
+            lines.pop()
+        return lines
+
+
+def is_binary_file(path):
+    with open(path, 'rb') as fh:
+        return b'\0' in fh.read(8000)
+
+
+def count_matching_lines(a, b, a_start, b_start, limit, step=1):
+    ''' Length of the common run of a[a_start:] and b[b_start:], at most limit lines.
+    step -1 counts backwards from a[a_start - 1] and b[b_start - 1].
+    Slices of growing size are compared, so a long run costs a few C level compares.
+    '''
+    count = 0
+    size = 1
+    while count < limit:
+        size = min(size, limit - count)
+        if step == 1:
+            is_match = a[a_start + count:a_start + count + size] == b[b_start + count:b_start + count + size]
+        else:
+            is_match = a[a_start - count - size:a_start - count] == b[b_start - count - size:b_start - count]
+        if is_match:
+            count += size
+            size *= 2
+        elif size == 1:
+            break
+        else:
+            size //= 2
+    return count
+
+
+def find_middle_snake(a, b, a_lo, a_hi, b_lo, b_hi):
+    ''' Myers linear space bisection - the point where forward and backward searches meet.
+    Return: (a index, b index) to split the ranges at, None if the ranges have nothing in common
+    '''
+    a_len, b_len = a_hi - a_lo, b_hi - b_lo
+    max_d = (a_len + b_len + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d + 2
+    forward = [-1] * v_length
+    backward = [-1] * v_length
+    forward[v_offset + 1] = 0
+    backward[v_offset + 1] = 0
+    delta = a_len - b_len
+    is_front = delta % 2 != 0
+    k1_start = k1_end = k2_start = k2_end = 0
+    for d in range(max_d):
+        for k1 in range(-d + k1_start, d + 1 - k1_end, 2):
+            k1_offset = v_offset + k1
+            if k1 == -d or (k1 != d and forward[k1_offset - 1] < forward[k1_offset + 1]):
+                x1 = forward[k1_offset + 1]
+            else:
+                x1 = forward[k1_offset - 1] + 1
+            y1 = x1 - k1
+            if x1 < a_len and y1 < b_len:
+                run = count_matching_lines(
+                    a, b, a_lo + x1, b_lo + y1, min(a_len - x1, b_len - y1))
+                x1 += run
+                y1 += run
+            forward[k1_offset] = x1
+            if x1 > a_len:
+                k1_end += 2
+            elif y1 > b_len:
+                k1_start += 2
+            elif is_front:
+                k2_offset = v_offset + delta - k1
+                if 0 <= k2_offset < v_length and backward[k2_offset] != -1:
+                    if x1 >= a_len - backward[k2_offset]:
+                        return a_lo + x1, b_lo + y1
+        for k2 in range(-d + k2_start, d + 1 - k2_end, 2):
+            k2_offset = v_offset + k2
+            if k2 == -d or (k2 != d and backward[k2_offset - 1] < backward[k2_offset + 1]):
+                x2 = backward[k2_offset + 1]
+            else:
+                x2 = backward[k2_offset - 1] + 1
+            y2 = x2 - k2
+            if x2 < a_len and y2 < b_len:
+                run = count_matching_lines(
+                    a, b, a_hi - x2, b_hi - y2, min(a_len - x2, b_len - y2), -1)
+                x2 += run
+                y2 += run
+            backward[k2_offset] = x2
+            if x2 > a_len:
+                k2_end += 2
+            elif y2 > b_len:
+                k2_start += 2
+            elif not is_front:
+                k1_offset = v_offset + delta - k2
+                if 0 <= k1_offset < v_length and forward[k1_offset] != -1:
+                    x1 = forward[k1_offset]
+                    y1 = v_offset + x1 - k1_offset
+                    if x1 >= a_len - x2:
+                        return a_lo + x1, b_lo + y1
+    return None
+
+
+def diff_lines(a, b):
+    ''' Myers diff of two line hash sequences, in linear space and without recursion.
+    Return: sorted list of (a start, a end, b start, b end) ranges which differ
+    '''
+    hunks = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        a_lo, a_hi, b_lo, b_hi = stack.pop()
+        prefix = count_matching_lines(
+            a, b, a_lo, b_lo, min(a_hi - a_lo, b_hi - b_lo))
+        a_lo += prefix
+        b_lo += prefix
+        suffix = count_matching_lines(
+            a, b, a_hi, b_hi, min(a_hi - a_lo, b_hi - b_lo), -1)
+        a_hi -= suffix
+        b_hi -= suffix
+        if a_lo == a_hi or b_lo == b_hi:
+            if a_lo != a_hi or b_lo != b_hi:
+                hunks.append((a_lo, a_hi, b_lo, b_hi))
+            continue
+        split = find_middle_snake(a, b, a_lo, a_hi, b_lo, b_hi)
+        if split is None:
+            hunks.append((a_lo, a_hi, b_lo, b_hi))
+            continue
+        a_split, b_split = split
+        stack.append((a_split, a_hi, b_split, b_hi))
+        stack.append((a_lo, a_split, b_lo, b_split))
+    return join_hunks(sorted(hunks))
+
+
+def join_hunks(hunks):
+    # join sorted hunks which touch each other
+    joined = []
+    for hunk in hunks:
+        if joined and joined[-1][1] == hunk[0] and joined[-1][3] == hunk[2]:
+            joined[-1] = (joined[-1][0], hunk[1], joined[-1][2], hunk[3])
+        else:
+            joined.append(hunk)
+    return joined
+
+
+def diff_line_files(a, b):
+    ''' diff_lines of two LineFile objects, lines are matched by their 64 bit hashes and the lines
+    taken as equal are then compared byte by byte - a line whose hash collided becomes a changed line.
+    Return: sorted list of (a start, a end, b start, b end) ranges which differ
+    '''
+    hunks = diff_lines(a.hashes, b.hashes)
+    collisions = []
+    a_position = b_position = 0
+    for a_start, a_end, b_start, b_end in hunks + [(len(a), len(a), len(b), len(b))]:
+        # the lines before the hunk are equal in both
+        for number in a.iter_different_lines(a_position, b, b_position, a_start - a_position):
+            collisions.append((a_position + number, a_position + number + 1, b_position + number, b_position + number + 1))
+        a_position, b_position = a_end, b_end
+    if not collisions:
+        return hunks
+    return join_hunks(sorted(hunks + collisions))
+
+
+def merge_line_files(base, ours, theirs, out_fh, our_label, their_label):
+    ''' diff3 merge of LineFile objects, writes the result to out_fh.
+    Changes from both sides which overlap in base, or touch each other, and differ become a conflict block.
+    Return: True if conflict markers were written
+    '''
+    hunks = sorted([(hunk, 0) for hunk in diff_line_files(base, ours)] +
+                   [(hunk, 1) for hunk in diff_line_files(base, theirs)])
+    deltas = [0, 0]
+    base_position = 0
+    is_conflicted = False
+    i = 0
+    while i < len(hunks):
+        group = [hunks[i]]
+        low, high = hunks[i][0][0], hunks[i][0][1]
+        i += 1
+        while i < len(hunks) and hunks[i][0][0] <= high:
+            group.append(hunks[i])
+            high = max(high, hunks[i][0][1])
+            i += 1
+        ours.copy_lines(base_position + deltas[0], low + deltas[0], out_fh)
+        ranges = []
+        for side in (0, 1):
+            side_hunks = [hunk for hunk, hunk_side in group if hunk_side == side]
+            if side_hunks:
+                side_low = side_hunks[0][2] - (side_hunks[0][0] - low)
+                side_high = side_hunks[-1][3] + (high - side_hunks[-1][1])
+            else:
+                side_low, side_high = low + deltas[side], high + deltas[side]
+            ranges.append((side_low, side_high))
+            deltas[side] = side_high - high
+        changed_sides = {hunk_side for _, hunk_side in group}
+        (our_low, our_high), (their_low, their_high) = ranges
+        if changed_sides == {1}:
+            theirs.copy_lines(their_low, their_high, out_fh)
+        elif changed_sides == {0} or (ours.hashes[our_low:our_high] == theirs.hashes[their_low:their_high] and
+                                      ours.read_bytes(our_low, our_high) == theirs.read_bytes(their_low, their_high)):
+            ours.copy_lines(our_low, our_high, out_fh)
+        else:
+            is_conflicted = True
+            out_fh.write(b'<<<<<<< ' + our_label + b'\n')
+            ours.copy_lines(our_low, our_high, out_fh, True)
+            out_fh.write(b'=======\n')
+            theirs.copy_lines(their_low, their_high, out_fh, True)
+            out_fh.write(b'>>>>>>> ' + their_label + b'\n')
+        base_position = high
+    ours.copy_lines(base_position + deltas[0], len(ours), out_fh)
+    return is_conflicted
+
+
+def pick_merge_mode(base_blob, our_blob, their_blob):
+    base_mode = FILE_MODE if base_blob is None else base_blob[0]
+    if our_blob[0] == base_mode:
+        return their_blob[0]
+    return our_blob[0]
+
+
+def merge_tree_changes(objects, base_tree_id, our_tree_id, their_tree_id):
+    ''' Three way merge of trees, only the paths changed since base are visited.
+    Return: (changes to apply on our tree as (path, our blob, their blob),
+             conflicts as (path, base blob, our blob, their blob)), blobs are (mode, blob id) or None
+    '''
+    our_changes = {path: new_blob for path, _,
+                   new_blob in objects.iter_tree_diff(base_tree_id, our_tree_id)}
+    changes, conflicts = [], []
+    for path, base_blob, their_blob in objects.iter_tree_diff(base_tree_id, their_tree_id):
+        if path not in our_changes:
+            changes.append((path, base_blob, their_blob))
+        elif our_changes[path] != their_blob:
+            conflicts.append(
+                (path, base_blob, our_changes[path], their_blob))
+    return changes, conflicts
+
+
+@traced('check uncommitted changes')
+def has_uncommitted_changes(wit, index, last_commit_id):
+    # stop on the first change found, untracked files are not uncommitted work
+    return any(iter_staged_changes(index.iter_blobs(), wit.iter_commit_files(last_commit_id))) or any(
+        kind != Changes.UNTRACKED for _, kind in iter_working_tree_changes(wit.wit_root_path, index, wit.get_sparse_patterns()))
+
+
+def apply_tree_diff(wit, index, old_tree_id, new_tree_id):
+    ''' Move working directory and index from one tree to another.
+    Only paths which differ between the trees are removed or written.
+    '''
+    apply_changes(wit, index, wit.objects.iter_tree_diff(
+        old_tree_id, new_tree_id), wit.get_sparse_patterns())
+
+
+@traced('apply changes')
+def apply_changes(wit, index, changes, sparse=None):
+    ''' Args: changes - (path, old blob, new blob) items, new blob None to remove the path
+              sparse - SparsePatterns, other paths are changed in the index only
+    '''
+    workdir = wit.wit_root_path
+    blobs = []
+    for path, _, new_blob in changes:
+        is_checked_out = sparse is None or sparse.matches(path)
+        if new_blob is None:
+            if is_checked_out:
+                remove_working_file(workdir, path)
+            index.remove_entries(path)
+        elif is_checked_out:
+            mode, blob_id = new_blob
+            blobs.append((blob_id, mode, os.path.join(workdir, path)))
+        else:
+            index.set_entry(path, *new_blob)
+    wit.objects.checkout_blobs(blobs)
+    for blob_id, mode, target_path in blobs:
+        index.set_entry(os.path.relpath(target_path, workdir),
+                        mode, blob_id, os.stat(target_path))
+
+
+def checkout(commit_id, jobs=1, paths=()):
+    commit_id = commit_id[0]
+    if paths:
+        checkout_paths(commit_id, paths, jobs)
+        return
+    print('checkout {}'.format(commit_id))
+    try:
+        wit = WitRepo(os.getcwd(), jobs)
+        wit.validate_repo_at_path(os.getcwd(), True)
+        commit_id, branch_name = wit.get_actual_commit_id_from_input(commit_id)
+    except WitException:
+        return
+    # Check if uncommitted files and unstaged files exist
+    last_commit_id = wit.get_current_commit_id()
+    index = wit.load_index()
+    if has_uncommitted_changes(wit, index, last_commit_id):
+        logging.error('Uncommitted work found, blocking checkout')
+        return
+    # Restore only the files which differ between HEAD image and the target image
+    head_tree_id = None
+    if last_commit_id is not None:
+        head_tree_id = wit.get_commit_tree_id(last_commit_id)
+    apply_tree_diff(wit, index, head_tree_id,
+                    wit.get_commit_tree_id(commit_id))
+    index.save()
+    # only now, a failed or blocked checkout keeps the active branch
+    wit.create_active_branch_file(branch_name)
+    ref_path = wit.wit_references_file
+    try:
+        if os.path.exists(ref_path):
+            wit.update_references_file(commit_id, 'checkout')
+    except WitException:
+        return
+
+
+def checkout_paths(commit_id, paths, jobs=1):
+    ''' Restore files from a commit into the working directory and the index, HEAD is not moved.
+    Args: paths - files or folders from the current folder, restored even outside the sparse checkout
+    '''
+    try:
+        wit = WitRepo(os.getcwd(), jobs)
+        wit.validate_repo_at_path(os.getcwd(), True)
+        tree_id = wit.get_commit_tree_id(wit.resolve_commit_id(commit_id))
+        index = wit.load_index()
+        files = []
+        for path in paths:
+            relative_path = os.path.relpath(os.path.abspath(path), wit.wit_root_path)
+            relative_path = '' if relative_path == '.' else relative_path
+            entry = wit.objects.get_tree_entry(tree_id, relative_path)
+            if entry is None:
+                raise WitException('Path "{}" did not match any file in {}'.format(path, commit_id))
+            mode, object_type, object_id = entry
+            if object_type == 'tree':
+                files.extend(wit.objects.iter_tree_files(object_id, relative_path))
+            else:
+                files.append((relative_path, mode, object_id))
+    except WitException:
+        return
+    changes = []
+    for path, mode, blob_id in files:
+        old_entry = index.get(path)
+        old_blob = None if old_entry is None else (old_entry.mode, old_entry.blob_id)
+        file_path = os.path.join(wit.wit_root_path, path)
+        if old_blob == (mode, blob_id) and os.path.isfile(file_path) and index.is_up_to_date(path, os.stat(file_path)):
+            continue
+        changes.append((path, old_blob, (mode, blob_id)))
+    apply_changes(wit, index, changes)
+    if index.is_changed:
+        index.save()
 
-    def create_active_branch_file(self, branch_name="master"):
-        with open(self.wit_active_branch_file, 'w') as fh:
-            fh.write(branch_name)
 
-    def get_active_branch(self):
-        with open(self.wit_active_branch_file, 'r') as fh:
-            active_branch = fh.readline()
-            return active_branch
+def sparse(paths, is_disabled):
+    ''' Show or set the paths checked out in the working directory.
+    Files of paths which leave the sparse checkout are removed unless they were changed,
+    files of paths which join it are written from the index.
+    Args: paths - files or folders from the current folder, may hold shell wildcards
+    '''
+    try:
+        wit = WitRepo(os.getcwd())
+        wit.validate_repo_at_path(os.getcwd(), True)
+    except WitException:
+        return
+    old_sparse = wit.get_sparse_patterns()
+    if not paths and not is_disabled:
+        if old_sparse is not None:
+            print('\n'.join(old_sparse.lines))
+        return
+    new_sparse = None
+    if not is_disabled:
+        lines = [os.path.relpath(os.path.abspath(path), wit.wit_root_path) for path in paths]
+        new_sparse = SparsePatterns(line.replace(os.sep, '/') for line in lines)
+    index = wit.load_index()
+    workdir = wit.wit_root_path
+    blobs = []
+    for path, entry in list(index.items()):
+        was_checked_out = old_sparse is None or old_sparse.matches(path)
+        is_checked_out = new_sparse is None or new_sparse.matches(path)
+        file_path = os.path.join(workdir, path)
+        if is_checked_out and not was_checked_out and not os.path.lexists(file_path):
+            blobs.append((entry.blob_id, entry.mode, file_path))
+        elif was_checked_out and not is_checked_out and os.path.isfile(file_path):
+            if index.is_up_to_date(path, os.stat(file_path)) or hash_file(file_path) == entry.blob_id:
+                remove_working_file(workdir, path)
+            else:
+                logging.warning('Keeping changed file {} outside the sparse checkout.'.format(path))
+    wit.objects.checkout_blobs(blobs)
+    for blob_id, mode, file_path in blobs:
+        index.set_entry(os.path.relpath(file_path, workdir), mode, blob_id, os.stat(file_path))
+    if index.is_changed:
+        index.save()
+    wit.set_sparse_patterns(new_sparse)
 
-    def get_current_commit_id(self):
-        if os.path.exists(self.wit_references_file):
-            return self.get_references_file_data().get('HEAD')
-        logging.debug('No reference file exist')
-        return None
 
-    def build_commit_history(self, show_all):
-        head_commit_id = self.get_current_commit_id()
-        if head_commit_id is None:
-            return self.commit_history
-        self.commit_history['Head'].append(head_commit_id)
-        self.traverse_history(head_commit_id)
-        self.branches = self.get_branches()
-        for branch, branch_commit_id in self.branches.items():
-            if show_all:
-                self.commit_history[branch].append(branch_commit_id)
-                self.traverse_history(branch_commit_id)
-            elif branch == 'master' and head_commit_id == branch_commit_id:
-                self.commit_history[branch].append(branch_commit_id)
-                self.traverse_history(branch_commit_id)
-        return self.commit_history
+def graph(show_all, max_count=None, since=None, is_collapsed=False, is_text=False):
+    wit = WitRepo(os.getcwd())
+    try:
+        wit.validate_repo_at_path(os.getcwd(), True)
+        since = parse_since(since) if since else None
+    except WitException:
+        return
+    if is_text:
+        write_stream(iter_graph_text(wit, show_all, max_count, since, is_collapsed))
+        return
+    check_dependencies()
+    try:
+        commit_history = wit.build_commit_history(show_all, max_count, since, is_collapsed)
+    except WitException:
+        return
+    if len(commit_history) > GRAPH_NODES_WARNING:
+        logging.warning('Graph has {} nodes, dot layout may be slow. '
+                        'Use --text, --max-count or --collapse for large histories.'.format(len(commit_history)))
+    wit.generate_graph()
 
-    def get_commit_file_data(self, filename):
-        return dict(line.rstrip().split('=') for line in open(filename) if not line.startswith("#"))
 
-    def traverse_history(self, commit, visited=set()):
-        if commit in visited:
-            return
-        visited.add(commit)
-        if commit != 'None':
-            commit_file = os.path.join(self.wit_images_dir, commit + '.txt')
-            parents = self.get_commit_file_data(commit_file).get('parent')
-            parents_ids = parents.split(',')
-            for p_id in parents_ids:
-                if p_id != 'None':
-                    self.commit_history[commit].append(p_id)
-                self.traverse_history(p_id, visited)
-        return self.commit_history
+def iter_graph_text(wit, show_all, max_count=None, since=None, is_collapsed=False):
+    ''' Text graph lines of the newest commits, made while the history is walked.
+    Args: is_collapsed - one line for a run of commits with one parent, one child and no reference
+    Return: generator of lines
+    '''
+    start_ids = wit.get_graph_start_ids(show_all)
+    if not start_ids:
+        return
+    is_colored = sys.stdout.isatty()
+    decorations = get_decorations(wit)
+    commit_graph = wit.get_commit_graph()
+    walk = commit_graph.iter_topo_order([commit_graph.find(commit_id) for commit_id in set(start_ids.values())], since)
+    lanes = GraphLanes()
+    children = Counter()
+    # [prefix, newest commit id, oldest position, count] of the linear run waiting to be written
+    run = None
 
-    def create_commit_id_file(self, commit_id, message, branch):
-        commit_file = os.path.join(self.wit_images_dir, commit_id + '.txt')
-        with open(commit_file, 'a') as fh:
-            if branch is None:
-                parent = self.get_current_commit_id()
-            else:
-                parent = '{},{}'.format(self.get_current_commit_id(), branch)
-            current_time = get_current_time()
-            data = "parent={}\ndate={}\nmessage={}\n".format(
-                parent, current_time, message)
-            fh.write(data)
+    def format_run(prefix, commit_id, position, count):
+        title = commit_id[:7]
+        if count > 1:
+            title = '{}..{}'.format(title, commit_graph.get_commit_id(position)[:7])
+        names = decorations.get(commit_id)
+        text = colored(title, 'yellow') if is_colored else title
+        if count > 1:
+            return '{} {} ({} commits)\n'.format(prefix, text, count)
+        message = wit.get_commit_file_data(os.path.join(wit.wit_images_dir, commit_id + '.txt')).get('message', '')
+        return '{} {}{} {}\n'.format(prefix, text, ' ({})'.format(', '.join(names)) if names else '', message)
 
-    def create_commit_id_folder(self, commit_id):
-        commit_path = os.path.join(self.wit_images_dir, commit_id)
-        os.mkdir(commit_path)
-        return commit_path
+    for position in islice(walk, max_count):
+        commit_id, parents, _, _ = commit_graph.get_record(position)
+        children.update(parents)
+        prefix, lines = lanes.add(position, parents)
+        is_linear = (is_collapsed and len(parents) == 1 and children[position] == 1
+                     and commit_id not in decorations and not lines)
+        if run is not None and is_linear and run[0] == prefix and commit_graph.get_record(run[2])[1] == [position]:
+            run[2] = position
+            run[3] += 1
+            continue
+        if run is not None:
+            yield format_run(*run)
+            run = None
+        if is_linear:
+            run = [prefix, commit_id, position, 1]
+            continue
+        yield format_run(prefix, commit_id, position, 1)
+        for line in lines:
+            yield line + '\n'
+    if run is not None:
+        yield format_run(*run)
 
-    def is_commit_id_exist(self, commit_id):
-        with os.scandir(self.wit_images_dir) as images_content:
-            for item in images_content:
-                if item.is_dir() and commit_id == item.name:
-                    return True
-            return False
 
-    def get_actual_commit_id_from_input(self, checkout_input):
-        ''' Parsing checkout input to actual commit_id
-        Args: checkout_input - could be either branch name (including 'master' branch) or commit id
-        Raises: WitException if references files does not exist or if commit id folder was not found
-        Return: valid commit id
-        '''
-        if checkout_input in self.get_branches():
-            if not os.path.exists(self.wit_references_file):
-                raise WitException('Cannot read reference file.')
-            actual_commit_id = self.get_references_file_data().get(checkout_input)
-            self.create_active_branch_file(checkout_input)
-        else:
-            actual_commit_id = checkout_input
-            self.create_active_branch_file("")
-        logging.warning('==> checkout {}'.format(actual_commit_id))
-        if not self.is_commit_id_exist(actual_commit_id):
-            raise WitException(
-                'Commit ID was not found: {}'.format(actual_commit_id))
-        return actual_commit_id
+def branch(name):
+    branch_name = name[0]
+    try:
+        wit = WitRepo(os.getcwd())
+        wit.validate_repo_at_path(os.getcwd(), True)
+        wit.update_branches(branch_name)
+    except WitException:
+        return
 
-    def generate_graph(self):
-        self.branches = self.get_branches()
-        active_branch = self.get_active_branch()
-        data = self.commit_history
-        graph = Digraph(name='wit_graph')
-        for k, v in data.items():
-            for item in v:
-                graph.edge(k, item)
-                if k in self.branches:
-                    graph.node(k, shape="plaintext")
-                    if k == active_branch:
-                        graph.node(k, label="{}*".format(k))
-        graph.graph_attr['rankdir'] = 'LR'
-        graph.edge_attr.update(arrowhead='vee', arrowsize='2')
-        graph.node('Head', shape="plaintext")
-        print(graph.source)
-        graph.view()
 
-    def before_merge(self, branch_name, head_commit_id):
-        # if branch and head are same -> nothing to do
-        self.branches = self.get_branches()
-        if branch_name not in self.branches:
-            raise WitException('Branch "{}" not found.'.format(branch_name))
-        branch_commit_id = self.branches.get(branch_name)
-        if head_commit_id == branch_commit_id:
-            raise WitException(
-                '"HEAD" and branch "{}" are the same -> do nothing.'.format(branch_name))
-        return branch_commit_id
+def merge(name):
+    branch_name = name[0]
+    try:
+        wit = WitRepo(os.getcwd())
+        wit.validate_repo_at_path(os.getcwd(), True)
+        wit.handle_merge_branch(branch_name)
+    except WitException:
+        return
 
-    def get_history_set_for_commit(self, commit_id):
-        history = set()
-        history.add(commit_id)
-        self.commit_history = defaultdict(list)
-        history_dict = self.traverse_history(commit_id)
-        for k, v in history_dict.items():
-            history.add(k)
-            for item in v:
-                history.add(item)
-        return history
 
-    def handle_merge_branch(self, branch_name):
-        head_commit_id = self.get_current_commit_id()
-        branch_commit_id = self.before_merge(branch_name, head_commit_id)
-        # find 'common commit' for head & branch
-        branch_history_set = self.get_history_set_for_commit(branch_commit_id)
-        head_history_set = self.get_history_set_for_commit(head_commit_id)
-        # TODO - could be more than 1?
-        common_commit_id = head_history_set.intersection(branch_history_set)
-        print(common_commit_id)
-        print(branch_history_set)
-        print(head_history_set)
-        # find changes from 'common commit' until branch
-        changes_set = branch_history_set.difference(common_commit_id)
-        print(changes_set)
-        # update staging area with the changes
-        for item in changes_set:
-            source_commit_id_path = os.path.join(self.wit_images_dir, item)
-            merge_override_tree(source_commit_id_path, self.wit_staging_dir)
-        # execute commit with the changes in staging
-        commit(['merge "{}"'.format(branch_name)], branch_commit_id)
+def iter_unified_hunks(hunks, old_length, new_length):
+    # join diff hunks closer than twice the context lines into one printed hunk
+    group = []
+    for hunk in hunks:
+        if group and hunk[0] - group[-1][1] > 2 * DIFF_CONTEXT:
+            yield get_unified_range(group, old_length, new_length), group
+            group = []
+        group.append(hunk)
+    if group:
+        yield get_unified_range(group, old_length, new_length), group
 
 
-def detect_changes(f):
-    def are_changes_exist():
-        try:
-            wit = WitRepo(os.getcwd())
-            wit.validate_repo_at_path(os.getcwd(), True)
-        except WitException:
-            return
-        last_commit_id = wit.get_current_commit_id()
-        if last_commit_id is None:
-            return True
-        last_commit_id_folder = os.path.join(
-            wit.wit_images_dir, last_commit_id)
-        if get_changes_to_be_committed(wit.wit_staging_dir, last_commit_id_folder, False):
-            return True
-        return False
+def get_unified_range(group, old_length, new_length):
+    old_start = max(0, group[0][0] - DIFF_CONTEXT)
+    old_end = min(old_length, group[-1][1] + DIFF_CONTEXT)
+    new_start = group[0][2] - (group[0][0] - old_start)
+    new_end = min(new_length, group[-1][3] + (old_end - group[-1][1]))
+    return old_start, old_end, new_start, new_end
 
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        changes_exist = are_changes_exist()
-        if not changes_exist:
-            logging.error('No changes detected in staging to be committed.')
-            return
-        return f(*args, **kwargs)
-    return decorated
 
+def format_unified_range(start, end):
+    if end - start == 0:
+        return '{},0'.format(start)
+    if end - start == 1:
+        return str(start + 1)
+    return '{},{}'.format(start + 1, end - start)
 
-def make_folders(root_dir, subfolders):
-    concat_path = partial(os.path.join, root_dir)
-    for path in map(concat_path, subfolders):
-        try:
-            os.makedirs(path, exist_ok=True)
-        except OSError as err:
-            logging.error("Directory {} can not be created".format(path))
-            raise err
 
+def iter_diff_lines(line_file, start, end, prefix, color):
+    for number, line in enumerate(line_file.read_lines(start, end), start):
+        text = prefix + line.decode('utf-8', 'replace')
+        yield (colored(text, color) if color and sys.stdout.isatty() else text) + '\n'
+        if number == len(line_file) - 1 and not line_file.ends_with_newline:
+            yield '\\ No newline at end of file\n'
 
-def init(args):
-    ''' Initialize wit work folders.
-    Args: None
-    Raises: OSError in case folder creation is failing.
-    Return: None
-    Assumption - if folders exists don't do anything.
+
+def iter_file_diff(old_name, old_path, new_name, new_path, header=()):
+    ''' Unified diff of two files, hunk by hunk.
+    Args: old_path/new_path - file content to compare, None for a file which does not exist
+          header - extra lines after the diff line, e.g. rename information
+    Return: generator of texts, the file header first and then one per hunk
     '''
-    wit = WitRepo(os.getcwd())
-    wit_dir = wit.wit_dir
-    subfolders = ('images', 'staging_area')
-    make_folders(wit_dir, subfolders)
-    wit.create_active_branch_file()
+    lines = ['diff --wit a/{} b/{}\n'.format(old_name or new_name, new_name or old_name)]
+    lines.extend(line + '\n' for line in header)
+    if any(path is not None and is_binary_file(path) for path in (old_path, new_path)):
+        lines.append('Binary files {} and {} differ\n'.format(
+            'a/' + old_name if old_path else '/dev/null', 'b/' + new_name if new_path else '/dev/null'))
+        yield ''.join(lines)
+        return
+    old_file, new_file = LineFile(old_path), LineFile(new_path)
+    hunks = diff_line_files(old_file, new_file)
+    if hunks:
+        lines.append(colored_header('--- {}'.format('a/' + old_name if old_path else '/dev/null')))
+        lines.append(colored_header('+++ {}'.format('b/' + new_name if new_path else '/dev/null')))
+    yield ''.join(lines)
+    for (old_start, old_end, new_start, new_end), group in iter_unified_hunks(hunks, len(old_file), len(new_file)):
+        text = '@@ -{} +{} @@'.format(format_unified_range(old_start, old_end),
+                                      format_unified_range(new_start, new_end))
+        lines = [(colored(text, 'cyan') if sys.stdout.isatty() else text) + '\n']
+        position = old_start
+        for hunk_old_start, hunk_old_end, hunk_new_start, hunk_new_end in group:
+            lines.extend(iter_diff_lines(old_file, position, hunk_old_start, ' ', None))
+            lines.extend(iter_diff_lines(old_file, hunk_old_start, hunk_old_end, '-', 'red'))
+            lines.extend(iter_diff_lines(new_file, hunk_new_start, hunk_new_end, '+', 'green'))
+            position = hunk_old_end
+        lines.extend(iter_diff_lines(old_file, position, old_end, ' ', None))
+        yield ''.join(lines)
 
 
-def get_relative_path(wit_root: Path, target: Path, is_file: bool) -> Path:
-    if is_file:
-        return target.parent.relative_to(wit_root.parent)
-    return target.relative_to(wit_root.parent)
+def colored_header(text):
+    if sys.stdout.isatty():
+        return colored(text, attrs=['bold']) + '\n'
+    return text + '\n'
 
 
-def handle_path_addition(wit_root_path, path_item):
-    realpath = os.path.realpath(path_item)
-    path = Path(realpath)
-    wit_root = Path(wit_root_path)
-    staging_path = os.path.join(wit_root_path, 'staging_area')
-    if os.path.isfile(path):
-        relative_path = get_relative_path(wit_root, path, True)
-        Path(os.path.join(staging_path, relative_path)).mkdir(
-            exist_ok=True, parents=True)
-        shutil.copy2(path_item, os.path.join(staging_path, relative_path))
-    else:
-        relative_path = get_relative_path(wit_root, path, False)
-        copy_tree(path_item, os.path.join(staging_path, relative_path))
+def get_line_counts(path):
+    # Counter of the line hashes of a file and its number of lines, None for a binary file
+    if is_binary_file(path):
+        return None
+    lines = Counter(LineFile(path).hashes)
+    return lines, sum(lines.values())
 
 
-def add(paths: List[str]):
-    # Check whether the path is valid and is under wit repo
-    for path_item in paths:
-        if not os.path.exists(path_item):
-            logging.error(
-                'Path "{}" did not match any files'.format(path_item))
-            return
-        try:
-            wit_root_path = WitRepo(
-                os.getcwd()).validate_repo_at_path(path_item, True)
-        except WitException:
-            return
-        handle_path_addition(wit_root_path, path_item)
+def get_similarity(old_counts, new_counts):
+    # percent of lines two files share, from get_line_counts of both
+    (old_lines, old_total), (new_lines, new_total) = old_counts, new_counts
+    if old_total + new_total == 0:
+        return 100
+    return 200 * sum((old_lines & new_lines).values()) // (old_total + new_total)
 
 
-def generate_id():
-    return ''.join(random.choices('abcdef' + string.digits, k=40))
+def find_renames(deleted, added):
+    ''' Pair deleted and added files which are the same or similar content.
+    Args: deleted, added - {path: (file path, blob id or None)}
+    Return: list of (similarity percent, old path, new path)
+    '''
+    renames = []
+    blob_paths = {}
+    for path, (_, blob_id) in added.items():
+        if blob_id is not None:
+            blob_paths.setdefault(blob_id, []).append(path)
+    # same content - compare hashes only
+    for path, (_, blob_id) in list(deleted.items()):
+        if blob_paths.get(blob_id):
+            new_path = blob_paths[blob_id].pop(0)
+            renames.append((100, path, new_path))
+            del deleted[path]
+            del added[new_path]
+    if len(deleted) * len(added) > RENAME_LIMIT * RENAME_LIMIT:
+        return renames
+    # every file is read once, not once per pair
+    old_counts = {path: get_line_counts(old_file) for path, (old_file, _) in deleted.items()}
+    new_counts = {path: get_line_counts(new_file) for path, (new_file, _) in added.items()}
+    candidates = []
+    for old_path, old_lines in old_counts.items():
+        if old_lines is None:
+            continue
+        for new_path, new_lines in new_counts.items():
+            if new_lines is None:
+                continue
+            similarity = get_similarity(old_lines, new_lines)
+            if similarity >= RENAME_SIMILARITY:
+                candidates.append((similarity, old_path, new_path))
+    for similarity, old_path, new_path in sorted(candidates, key=lambda item: (-item[0], item[1], item[2])):
+        if old_path in deleted and new_path in added:
+            renames.append((similarity, old_path, new_path))
+            del deleted[old_path]
+            del added[new_path]
+    return renames
 
 
-def get_current_time():
-    return datetime.now(tzlocal()).strftime("%a %b %d %H:%M:%S %Y %z")
+def iter_diff_changes(wit, index, commit_ids, is_staged):
+    ''' Changed files for the diff command, unchanged files are skipped by their hashes.
+    Return: generator of (path, old file, old blob id, new file, new blob id), file path None for a missing file
+    '''
+    objects = wit.objects
+    workdir = wit.wit_root_path
+    if len(commit_ids) == 2:
+        # commit vs commit
+        for path, old_blob, new_blob in objects.iter_tree_diff(wit.get_commit_tree_id(commit_ids[0]), wit.get_commit_tree_id(commit_ids[1])):
+            yield path, *get_blob_file(objects, old_blob), *get_blob_file(objects, new_blob)
+        return
+    if is_staged:
+        # staging vs HEAD, or vs the given commit
+        commit_files = wit.iter_commit_files(commit_ids[0] if commit_ids else wit.get_current_commit_id())
+        for path, old_blob_id, new_blob_id in iter_path_join(commit_files, index.iter_blobs()):
+            if old_blob_id != new_blob_id:
+                yield path, *get_blob_file(objects, old_blob_id), *get_blob_file(objects, new_blob_id)
+        return
+    working_tree_changes = {path: kind for path, kind in iter_working_tree_changes(
+        workdir, index, wit.get_sparse_patterns()) if kind != Changes.UNTRACKED}
+    if not commit_ids:
+        # working directory vs staging
+        for path, kind in working_tree_changes.items():
+            new_file = None if kind == Changes.DELETED else os.path.join(workdir, path)
+            yield path, *get_blob_file(objects, index[path].blob_id), new_file, None
+        return
+    # working directory vs commit
+    for path, old_blob_id, index_blob_id in iter_path_join(wit.iter_commit_files(commit_ids[0]), index.iter_blobs()):
+        kind = working_tree_changes.get(path)
+        if kind == Changes.DELETED or index_blob_id is None:
+            new_file, new_blob_id = None, None
+        elif kind == Changes.MODIFIED:
+            new_file = os.path.join(workdir, path)
+            new_blob_id = hash_file(new_file)
+        else:
+            new_file, new_blob_id = os.path.join(workdir, path), index_blob_id
+        if old_blob_id != new_blob_id:
+            yield path, *get_blob_file(objects, old_blob_id), new_file, new_blob_id
 
 
-@detect_changes
-def commit(message, branch=None):
-    message = message[0]
+def get_blob_file(objects, blob):
+    # blob - blob id or (mode, blob id) -> (object file, blob id)
+    if blob is None:
+        return None, None
+    blob_id = blob[1] if isinstance(blob, tuple) else blob
+    return objects.get_object_file(blob_id), blob_id
+
+
+def diff(commits, is_staged):
+    if len(commits) > 2:
+        logging.error('diff takes at most two commits.')
+        return
     try:
         wit = WitRepo(os.getcwd())
         wit.validate_repo_at_path(os.getcwd(), True)
+        commit_ids = [wit.resolve_commit_id(item) for item in commits]
     except WitException:
         return
-    staging_path = wit.wit_staging_dir
-    # Part I - generate ID and create folder
-    commit_id = generate_id()
-    commit_path = wit.create_commit_id_folder(commit_id)
-    # Part II - Create metadata file
-    wit.create_commit_id_file(commit_id, message, branch)
-    # Part III - save staging content
-    copy_tree(staging_path, commit_path)
-    # Part IV - manage reference data
-    ref_path = wit.wit_references_file
-    if os.path.exists(ref_path):
-        wit.update_references_file(commit_id)
-    else:
-        wit.create_references_file(commit_id, commit_id, wit.branches)
-
-
-def get_modified_files(dcmp):
-    modified_files = []
-    for items in dcmp.diff_files:
-        modified_files.append(os.path.join(dcmp.left, items))
-    for sub_items in dcmp.subdirs.values():
-        modified_files.extend(get_modified_files(sub_items))
-    return modified_files
-
-
-def get_new_files(dcmp):
-    new_files = []
-    for items in dcmp.left_only:
-        new_files.append(os.path.join(dcmp.left, items))
-    for sub_items in dcmp.subdirs.values():
-        new_files.extend(get_new_files(sub_items))
-    return new_files
-
-
-def get_deleted_files(dcmp):
-    deleted_files = []
-    for items in dcmp.right_only:
-        deleted_files.append(os.path.join(dcmp.left, items))
-    for sub_items in dcmp.subdirs.values():
-        deleted_files.extend(get_deleted_files(sub_items))
-    return deleted_files
-
-
-def get_changes_to_be_committed(stage_area, last_commit, required=True):
-    # Compare content of staging area to last commit id folder
-    if last_commit is None:
-        last_commit = os.path.join(Path(stage_area).parent, "images")
-    dcmp = dircmp(stage_area, last_commit)
-    list_of_modified_files = get_modified_files(dcmp)
-    list_of_new_files = get_new_files(dcmp)
-    if len(list_of_modified_files) + len(list_of_new_files) == 0:
-        if required:
-            return '\tNo changes detected\n'
-        return False
-    if required:
-        return '\n'.join(colored('\tnew file:\t' + os.path.relpath(item, stage_area), 'green') for item in list_of_new_files) + '\n' + '\n'.join(colored('\tmodified file:\t' + os.path.relpath(item, stage_area), 'yellow') for item in list_of_modified_files) + '\n'
-    return True
+    index = wit.load_index()
+    write_stream(iter_diff_texts(wit, index, commit_ids, is_staged))
+    if index.is_changed:
+        index.save()
 
 
-def get_changes_not_committed(workdir, stage_area, required=True):
-    # Compare content of actual working directory to the staging area
-    dcmp = dircmp(workdir, stage_area, ignore=['.wit'])
-    list_of_modified_files = get_modified_files(dcmp)
-    printable_modified_files = (colored('\tmodified file:\t' + os.path.relpath(
-        Path(item), os.getcwd()), 'yellow') for item in list_of_modified_files)
-    list_of_deleted_files = get_deleted_files(dcmp)
-    printable_deleted_files = (
-        colored('\tdeleted file:\t' + os.path.relpath(item, os.getcwd()), 'red') for item in list_of_deleted_files)
-    if len(list_of_modified_files) + len(list_of_deleted_files) == 0:
-        if required:
-            return '\tNo changes detected\n'
-        return False
-    if required:
-        return '\n'.join(printable_modified_files) + '\n' + '\n'.join(printable_deleted_files) + '\n'
-    return True
+def iter_diff_texts(wit, index, commit_ids, is_staged):
+    deleted, added = {}, {}
+    # modified files are written as soon as found, added and deleted ones wait for rename detection
+    for path, old_file, old_blob_id, new_file, new_blob_id in iter_diff_changes(wit, index, commit_ids, is_staged):
+        if old_file is None:
+            added[path] = (new_file, new_blob_id)
+        elif new_file is None:
+            deleted[path] = (old_file, old_blob_id)
+        else:
+            yield from iter_file_diff(path, old_file, path, new_file)
+    old_files = {path: old_file for path, (old_file, _) in deleted.items()}
+    new_files = {path: new_file for path, (new_file, _) in added.items()}
+    for similarity, old_path, new_path in find_renames(deleted, added):
+        yield from iter_file_diff(old_path, old_files[old_path], new_path, new_files[new_path], [
+            'similarity index {}%'.format(similarity), 'rename from {}'.format(old_path), 'rename to {}'.format(new_path)])
+    for path, (old_file, _) in sorted(deleted.items()):
+        yield from iter_file_diff(path, old_file, path, None, ['deleted file'])
+    for path, (new_file, _) in sorted(added.items()):
+        yield from iter_file_diff(path, None, path, new_file, ['new file'])
 
 
-def get_untracked_files(workdir, stage_area):
-    # Compare actual working directory to the staging area to find new files which are not in staging
-    dcmp = dircmp(workdir, stage_area, ignore=['.wit'])
-    list_of_new_files = get_new_files(dcmp)
-    printable_new_files = (
-        colored('\t' + os.path.relpath(item, os.getcwd()), 'red') for item in list_of_new_files)
-    return '\n'.join(printable_new_files)
+def get_decorations(wit):
+    # {commit id: reference names}, HEAD first and pointing to the active branch
+    decorations = defaultdict(list)
+    references = wit.get_references_file_data()
+    active_branch = wit.get_active_branch()
+    head = references.pop('HEAD', None)
+    if head is not None:
+        if references.get(active_branch) == head:
+            references.pop(active_branch)
+            decorations[head].append('HEAD -> {}'.format(active_branch))
+        else:
+            decorations[head].append('HEAD')
+    for name, commit_id in references.items():
+        decorations[commit_id].append(name)
+    return decorations
 
 
-def status():
+def parse_since(since):
+    ''' Args: since - date and time text, local time unless it has a timezone
+    Raises: WitException if it is not a date
+    Return: timestamp
+    '''
     try:
-        wit = WitRepo(os.getcwd())
-        wit_root_path = wit.validate_repo_at_path(os.getcwd(), True)
-    except WitException:
-        return
-    last_commit_id = wit.get_current_commit_id()
-    if last_commit_id is None:
-        print('No commits yet\n\nChanges to be committed:\n{}\nChanges not staged for commit:\n{}\nUntracked files:\n{}\n'.format(
-            get_changes_to_be_committed(wit.wit_staging_dir, None), get_changes_not_committed(Path(wit_root_path).parent, wit.wit_staging_dir), get_untracked_files(Path(wit_root_path).parent, wit.wit_staging_dir)))
-    else:
-        last_commit_id_folder = os.path.join(
-            wit.wit_images_dir, last_commit_id)
-        print('Current commit ID: {}\nChanges to be committed:\n{}\nChanges not staged for commit:\n{}\nUntracked files:\n{}\n'.format(
-            last_commit_id, get_changes_to_be_committed(wit.wit_staging_dir, last_commit_id_folder), get_changes_not_committed(Path(wit_root_path).parent, wit.wit_staging_dir), get_untracked_files(Path(wit_root_path).parent, wit.wit_staging_dir)))
+        date = lazy_import('dateutil.parser').parse(since)
+    except (ValueError, OverflowError):
+        raise WitException('Invalid date: {}'.format(since))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=lazy_import('dateutil.tz').tzlocal())
+    return int(date.timestamp())
 
 
-def handle_path_removal(wit_root_path, path_item):
-    staging_path = os.path.join(wit_root_path, 'staging_area')
-    path_to_delete = os.path.join(staging_path, path_item)
-    if not os.path.exists(path_to_delete):
-        logging.error('File to delete from staging was not there.')
-        return
-    if os.path.isfile(path_to_delete):
-        print('deleting file: {}'.format(path_to_delete))
-        os.remove(path_to_delete)
-    else:
-        print('deleting folder: {}'.format(path_to_delete))
-        shutil.rmtree(path_to_delete)
+def is_path_changed(objects, tree_id, parent_tree_id, paths):
+    return any(objects.get_tree_entry(tree_id, path) != objects.get_tree_entry(parent_tree_id, path) for path in paths)
 
 
-def rm(paths):
-    # Check whether the path is valid and is under wit repo
-    for path_item in paths:
-        if not os.path.exists(path_item):
-            logging.error(
-                'Path "{}" did not match any files'.format(path_item))
-            return
-        try:
-            wit_root_path = WitRepo(
-                os.getcwd()).validate_repo_at_path(path_item, True)
-        except WitException:
-            return
-        handle_path_removal(wit_root_path, path_item)
+def iter_log_entries(wit, commit_ids, paths=(), is_topo_order=False, since=None):
+    ''' Commits reachable from commit_ids, newest first, read while they are consumed.
+    Args: paths - relative paths, only commits which changed one of them compared to the first parent.
+                  Commits are ruled out by their changed path filters first, their trees are read only if that fails.
+    Return: generator of (commit id, parent ids, commit file data)
+    '''
+    commit_graph = wit.get_commit_graph()
+    path_filters = wit.get_path_filters() if paths else None
+    positions = [commit_graph.find(commit_id) for commit_id in commit_ids]
+    if is_topo_order:
+        walk = commit_graph.iter_topo_order(positions, since)
+    else:
+        walk = commit_graph.iter_newest_first(positions, since)
+    for position in walk:
+        commit_id, parents, _, _ = commit_graph.get_record(position)
+        parent_ids = [commit_graph.get_commit_id(parent) for parent in parents]
+        if paths:
+            if not path_filters.is_changed(position, paths):
+                continue
+            parent_tree_id = wit.get_commit_tree_id(parent_ids[0]) if parent_ids else None
+            if not is_path_changed(wit.objects, wit.get_commit_tree_id(commit_id), parent_tree_id, paths):
+                continue
+        yield commit_id, parent_ids, wit.get_commit_file_data(os.path.join(wit.wit_images_dir, commit_id + '.txt'))
 
 
-def merge_override_tree(sourceRoot, destRoot):
-    # https://stackoverflow.com/questions/22588225/how-do-you-merge-two-directories-or-move-with-replace-from-the-windows-command
-    ''' Updates destination and override existing files.
-    Args:
-        sourceRoot: source root folder of files to copy
-        destRoot:   Destination root folder for files to be created
-    '''
-    for path, _, files in os.walk(sourceRoot):
-        relPath = os.path.relpath(path, sourceRoot)
-        destPath = os.path.join(destRoot, relPath)
-        if not os.path.exists(destPath):
-            try:
-                os.makedirs(destPath)
-            except OSError as err:
-                raise err
-        for file in files:
-            destFile = os.path.join(destPath, file)
-            srcFile = os.path.join(path, file)
-            shutil.copy(srcFile, destFile)
+def format_log_entry(commit_id, parent_ids, data, decorations, is_oneline):
+    is_colored = sys.stdout.isatty()
+    names = decorations.get(commit_id)
+    decoration = ' ({})'.format(', '.join(names)) if names else ''
+    if is_oneline:
+        title = commit_id[:7]
+        return '{}{} {}\n'.format(colored(title, 'yellow') if is_colored else title, decoration, data.get('message', ''))
+    title = 'commit {}'.format(commit_id)
+    lines = [(colored(title, 'yellow') if is_colored else title) + decoration]
+    if len(parent_ids) > 1:
+        lines.append('Merge: {}'.format(' '.join(parent_id[:7] for parent_id in parent_ids)))
+    lines.append('Date:   {}'.format(data.get('date', '')))
+    lines.append('')
+    lines.append('    {}'.format(data.get('message', '')))
+    return '\n'.join(lines) + '\n\n'
 
 
-def checkout(commit_id):
-    commit_id = commit_id[0]
-    print('checkout {}'.format(commit_id))
+def log(revisions, max_count, since, is_oneline, is_topo_order, paths):
     try:
         wit = WitRepo(os.getcwd())
-        wit_root_path = wit.validate_repo_at_path(os.getcwd(), True)
-        commit_id = wit.get_actual_commit_id_from_input(commit_id)
+        wit.validate_repo_at_path(os.getcwd(), True)
+        if wit.get_current_commit_id() is None:
+            raise WitException('No commits yet.')
+        commit_ids = [wit.resolve_commit_id(revision) for revision in revisions or ['HEAD']]
+        since = parse_since(since) if since else None
     except WitException:
         return
-    # Check if uncommitted files and unstaged files exist
-    last_commit_id = wit.get_current_commit_id()
-    last_commit_id_folder = os.path.join(wit.wit_images_dir, last_commit_id)
-    if get_changes_to_be_committed(wit.wit_staging_dir, last_commit_id_folder, False) or get_changes_not_committed(Path(wit_root_path).parent, wit.wit_staging_dir, False):
-        logging.error('Uncommitted work found, blocking checkout')
-        return
-    # Copy and override image's files, one by one, to their original location
-    source_commit_id_path = os.path.join(wit.wit_images_dir, commit_id)
-    working_dir_target = Path(wit_root_path).parent
-    merge_override_tree(source_commit_id_path, working_dir_target)
-    merge_override_tree(source_commit_id_path, wit.wit_staging_dir)
-    ref_path = wit.wit_references_file
-    if os.path.exists(ref_path):
-        wit.update_references_file(commit_id, 'checkout')
+    # paths are given from the current folder, trees hold them from the repository root
+    paths = [os.path.relpath(os.path.abspath(path), wit.wit_root_path) for path in paths]
+    paths = ['' if path == '.' else path for path in paths]
+    decorations = get_decorations(wit)
+    entries = islice(iter_log_entries(wit, commit_ids, paths, is_topo_order, since), max_count)
+    write_stream(format_log_entry(*entry, decorations, is_oneline) for entry in entries)
 
 
-def graph(show_all):
-    wit = WitRepo(os.getcwd())
+def find_path_change(wit, position, path):
+    ''' First commit from position back along first parents whose file at path differs from its parent's.
+    Commits are ruled out by their changed path filters first, their trees are read only if that fails.
+    Return: (record position, parent record position or None)
+    '''
+    commit_graph = wit.get_commit_graph()
+    path_filters = wit.get_path_filters()
+    while True:
+        commit_id, parents, _, _ = commit_graph.get_record(position)
+        if not parents:
+            return position, None
+        if path_filters.is_changed(position, [path]) and is_path_changed(
+                wit.objects, wit.get_commit_tree_id(commit_id), wit.get_commit_tree_id(commit_graph.get_commit_id(parents[0])), [path]):
+            return position, parents[0]
+        position = parents[0]
+
+
+def get_blame(wit, commit_id, path):
+    ''' Commit which last changed every line of a file, following first parents like git blame --first-parent.
+    Lines a merge brought in are blamed on the merge commit.
+    Raises: WitException if path is not a file in the commit
+    Return: (LineFile of the file in commit_id, list of the commit id of every line)
+    '''
+    objects = wit.objects
+    entry = objects.get_tree_entry(wit.get_commit_tree_id(commit_id), path)
+    if entry is None or entry[1] != 'blob':
+        raise WitException('Path "{}" is not a file in {}'.format(path, commit_id))
+    blame_file = LineFile(objects.get_object_file(entry[2]))
+    if is_binary_file(blame_file.path):
+        raise WitException('Binary file {} can not be blamed'.format(path))
+    commit_graph = wit.get_commit_graph()
+    blamed = [None] * len(blame_file)
+    # (line number in blame_file, line number in line_file) of the lines not blamed yet
+    pending = list(enumerate(range(len(blame_file))))
+    position, line_file = commit_graph.find(commit_id), blame_file
+    while pending:
+        position, parent = find_path_change(wit, position, path)
+        changer_id = commit_graph.get_commit_id(position)
+        parent_entry = None if parent is None else objects.get_tree_entry(
+            wit.get_commit_tree_id(commit_graph.get_commit_id(parent)), path)
+        if parent_entry is None or parent_entry[1] != 'blob':
+            # the file was added here
+            for number, _ in pending:
+                blamed[number] = changer_id
+            break
+        parent_file = LineFile(objects.get_object_file(parent_entry[2]))
+        hunks = diff_line_files(parent_file, line_file)
+        # lines inside a hunk are this commit's, the others move to their line number in the parent
+        still_pending = []
+        hunk_index, shift = 0, 0
+        for number, line in pending:
+            while hunk_index < len(hunks) and hunks[hunk_index][3] <= line:
+                old_start, old_end, new_start, new_end = hunks[hunk_index]
+                shift += (new_end - new_start) - (old_end - old_start)
+                hunk_index += 1
+            if hunk_index < len(hunks) and hunks[hunk_index][2] <= line:
+                blamed[number] = changer_id
+            else:
+                still_pending.append((number, line - shift))
+        pending, position, line_file = still_pending, parent, parent_file
+    return blame_file, blamed
+
+
+def blame(path, commit=None):
     try:
+        wit = WitRepo(os.getcwd())
         wit.validate_repo_at_path(os.getcwd(), True)
-        wit.build_commit_history(show_all)
-        wit.generate_graph()
+        commit_id = wit.resolve_commit_id(commit or 'HEAD')
+        relative_path = os.path.relpath(os.path.abspath(path), wit.wit_root_path)
+        blame_file, blamed = get_blame(wit, commit_id, relative_path)
     except WitException:
         return
+    dates = {}
+    for line_commit_id in set(blamed):
+        data = wit.get_commit_file_data(os.path.join(wit.wit_images_dir, line_commit_id + '.txt'))
+        dates[line_commit_id] = data.get('date', '')
+    width = len(str(len(blame_file)))
+    lines = blame_file.read_lines(0, len(blame_file))
+    write_stream('{} ({} {:>{}}) {}\n'.format(line_commit_id[:8], dates[line_commit_id], number, width,
+                                              line.decode('utf-8', 'replace'))
+                 for number, (line_commit_id, line) in enumerate(zip(blamed, lines), 1))
 
 
-def branch(name):
-    branch_name = name[0]
+def write_stream(texts):
+    # write every text as soon as it is made, the first page shows up without walking all history
+    try:
+        for text in texts:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # reader closed the pipe, e.g. head or a pager
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+def config(name, value):
     try:
         wit = WitRepo(os.getcwd())
         wit.validate_repo_at_path(os.getcwd(), True)
-        wit.update_branches(branch_name)
+        if value is None:
+            print(wit.get_config().get(name, ''))
+        else:
+            wit.set_config(name, value)
     except WitException:
         return
 
 
-def merge(name):
-    branch_name = name[0]
+def iter_delta_bases(objects, tree_id, path, newer, visited):
+    # (object id, base object id) of the objects in a tree, the base is the newer object at the same path
+    if tree_id in visited:
+        return
+    visited.add(tree_id)
+    yield tree_id, newer.get(path)
+    newer[path] = tree_id
+    for _, object_type, object_id, name in objects.read_tree(tree_id):
+        child_path = os.path.join(path, name)
+        if object_type == 'tree':
+            yield from iter_delta_bases(objects, object_id, child_path, newer, visited)
+        else:
+            if object_id not in visited:
+                visited.add(object_id)
+                yield object_id, newer.get(child_path)
+            newer[child_path] = object_id
+
+
+def gc():
     try:
         wit = WitRepo(os.getcwd())
         wit.validate_repo_at_path(os.getcwd(), True)
-        wit.handle_merge_branch(branch_name)
     except WitException:
         return
+    # newest commits first - recent objects are stored whole, older versions as deltas against them
+    commit_graph = wit.get_commit_graph()
+    delta_bases, newer, visited = [], {}, set()
+    for position in reversed(range(len(commit_graph))):
+        commit_id = commit_graph.get_commit_id(position)
+        tree_id = wit.get_commit_tree_id(commit_id)
+        image_dir = os.path.join(wit.wit_images_dir, commit_id)
+        if os.path.isdir(image_dir):
+            # image folder made before the object store, imported by get_commit_tree_id
+            shutil.rmtree(image_dir)
+        delta_bases.extend(iter_delta_bases(wit.objects, tree_id, '', newer, visited))
+    count, deltas = wit.objects.repack(delta_bases)
+    print('Packed {} objects, {} of them as deltas.'.format(count, deltas))
+    if os.path.exists(wit.wit_references_file):
+        try:
+            wit.get_references().update({}, pack=True)
+        except WitException:
+            return
 
 
 def parse_input(argv):
@@ -618,115 +3967,269 @@ def parse_input(argv):
     subparsers = parser.add_subparsers(
         title='Valid commands', dest="command")
     subparsers.required = True
+    # build only the parser of the given command, all of them for help or an unknown command
+    command = argv[0] if argv else None
+    if command not in {value for name, value in vars(Commends).items() if name.isupper()}:
+        command = None
 
-    # create the parser for the "init" command
-    parser_init = subparsers.add_parser(
-        Commends.INIT, help="Create an empty wit repository or reinitialize an existing one.")
-    parser_init.add_argument("path",
-                             metavar="path",
-                             nargs="?",
-                             default=".",
-                             help="Location to create the wit repository.")
-    parser_init.set_defaults(func=init)
-
-    # create the parser for the "add" command
-    parser_add = subparsers.add_parser(
-        Commends.ADD, help="Add a file or a folder content into staging area.")
-    parser_add.add_argument("path",
-                            metavar="path",
-                            nargs="+",
-                            default=".",
-                            help="file or folder to add to repo.")
-    parser_add.set_defaults(func=add)
-
-    # create the parser for the "commit" command
-    parser_commit = subparsers.add_parser(
-        Commends.COMMIT, help="Create image restoration point.")
-    parser_commit.add_argument("message",
-                               metavar="Message",
-                               nargs="+",
-                               help="Commit text message assigned to image.")
-    parser_commit.set_defaults(func=commit)
-
-    # create the parser for the "status" command
-    parser_status = subparsers.add_parser(
-        Commends.STATUS, help="View repository status.")
-    parser_status.set_defaults(func=status)
-
-    # create the parser for the "rm" command
-    parser_rm = subparsers.add_parser(
-        Commends.RM, help="Remove files from staging area.")
-    parser_rm.add_argument("path",
-                           metavar="path",
-                           nargs="+",
-                           help="File or folder to remove from staging.")
-    parser_rm.set_defaults(func=rm)
-
-    # create the parser for the "checkout" command
-    parser_checkout = subparsers.add_parser(
-        Commends.CHECKOUT, help="Move to a different image.")
-    parser_checkout.add_argument("commit_id",
-                                 metavar="Commit ID",
-                                 nargs="+",
-                                 type=str,
-                                 help="Commit ID which mark the image restoration point.")
-    parser_checkout.set_defaults(func=checkout)
-
-    # create the parser for the "graph" command
-    parser_graph = subparsers.add_parser(
-        Commends.GRAPH, help="Display wit commits graph.")
-    parser_graph.add_argument("--all",
-                              metavar="all commits",
-                              nargs="?",
-                              const=True,
-                              default=False,
-                              help="show all commits history.")
-    parser_graph.set_defaults(func=graph)
-
-    # create the parser for the "branch" command
-    parser_branch = subparsers.add_parser(
-        Commends.BRANCH, help="Create a branch tag.")
-    parser_branch.add_argument("name",
-                               metavar="name",
+    if command in (None, Commends.INIT):
+        # create the parser for the "init" command
+        parser_init = subparsers.add_parser(
+            Commends.INIT, help="Create an empty wit repository or reinitialize an existing one.")
+        parser_init.add_argument("path",
+                                 metavar="path",
+                                 nargs="?",
+                                 default=".",
+                                 help="Location to create the wit repository.")
+        parser_init.set_defaults(func=init)
+
+    if command in (None, Commends.ADD):
+        # create the parser for the "add" command
+        parser_add = subparsers.add_parser(
+            Commends.ADD, help="Add a file or a folder content into staging area.")
+        parser_add.add_argument("path",
+                                metavar="path",
+                                nargs="+",
+                                default=".",
+                                help="file or folder to add to repo.")
+        parser_add.add_argument("-j", "--jobs",
+                                metavar="N",
+                                type=int,
+                                default=1,
+                                help="number of parallel file workers, 0 for one per CPU.")
+        parser_add.set_defaults(func=add)
+
+    if command in (None, Commends.COMMIT):
+        # create the parser for the "commit" command
+        parser_commit = subparsers.add_parser(
+            Commends.COMMIT, help="Create image restoration point.")
+        parser_commit.add_argument("message",
+                                   metavar="Message",
+                                   nargs="+",
+                                   help="Commit text message assigned to image.")
+        parser_commit.add_argument("-j", "--jobs",
+                                   metavar="N",
+                                   type=int,
+                                   default=1,
+                                   help="number of parallel file workers, 0 for one per CPU.")
+        parser_commit.set_defaults(func=commit)
+
+    if command in (None, Commends.STATUS):
+        # create the parser for the "status" command
+        parser_status = subparsers.add_parser(
+            Commends.STATUS, help="View repository status.")
+        parser_status.add_argument("-j", "--jobs",
+                                   metavar="N",
+                                   type=int,
+                                   default=1,
+                                   help="folders and files read at once, 0 for one per CPU. More than the CPUs helps on network file systems.")
+        parser_status.set_defaults(func=status)
+
+    if command in (None, Commends.RM):
+        # create the parser for the "rm" command
+        parser_rm = subparsers.add_parser(
+            Commends.RM, help="Remove files from staging area.")
+        parser_rm.add_argument("path",
+                               metavar="path",
                                nargs="+",
-                               help="branch name")
-    parser_branch.set_defaults(func=branch)
-
-    # create the parser for the "merge" command
-    parser_merge = subparsers.add_parser(
-        Commends.MERGE, help="Create merge point between head and branch.")
-    parser_merge.add_argument("name",
-                              metavar="name",
-                              nargs="+",
-                              help="branch name")
-    parser_merge.set_defaults(func=merge)
+                               help="File or folder to remove from staging.")
+        parser_rm.set_defaults(func=rm)
+
+    if command in (None, Commends.CHECKOUT):
+        # create the parser for the "checkout" command
+        parser_checkout = subparsers.add_parser(
+            Commends.CHECKOUT, help="Move to a different image, or restore only the paths which follow a '--'.")
+        parser_checkout.add_argument("commit_id",
+                                     metavar="Commit ID",
+                                     nargs="+",
+                                     type=str,
+                                     help="Commit ID which mark the image restoration point.")
+        parser_checkout.add_argument("-j", "--jobs",
+                                     metavar="N",
+                                     type=int,
+                                     default=1,
+                                     help="number of parallel file workers, 0 for one per CPU.")
+        parser_checkout.set_defaults(func=checkout)
+
+    if command in (None, Commends.GRAPH):
+        # create the parser for the "graph" command
+        parser_graph = subparsers.add_parser(
+            Commends.GRAPH, help="Display wit commits graph.")
+        parser_graph.add_argument("--all",
+                                  metavar="all commits",
+                                  nargs="?",
+                                  const=True,
+                                  default=False,
+                                  help="show all commits history.")
+        parser_graph.add_argument("-n", "--max-count",
+                                  type=int,
+                                  help="show only the newest N commits.")
+        parser_graph.add_argument("--since",
+                                  help="show only commits newer than a date.")
+        parser_graph.add_argument("--collapse",
+                                  action="store_true",
+                                  help="show a run of commits without branches or merges as one node.")
+        parser_graph.add_argument("--text",
+                                  action="store_true",
+                                  help="draw the graph as text instead of graphviz.")
+        parser_graph.set_defaults(func=graph)
+
+    if command in (None, Commends.BRANCH):
+        # create the parser for the "branch" command
+        parser_branch = subparsers.add_parser(
+            Commends.BRANCH, help="Create a branch tag.")
+        parser_branch.add_argument("name",
+                                   metavar="name",
+                                   nargs="+",
+                                   help="branch name")
+        parser_branch.set_defaults(func=branch)
+
+    if command in (None, Commends.MERGE):
+        # create the parser for the "merge" command
+        parser_merge = subparsers.add_parser(
+            Commends.MERGE, help="Create merge point between head and branch.")
+        parser_merge.add_argument("name",
+                                  metavar="name",
+                                  nargs="+",
+                                  help="branch name")
+        parser_merge.set_defaults(func=merge)
+
+    if command in (None, Commends.CONFIG):
+        # create the parser for the "config" command
+        parser_config = subparsers.add_parser(
+            Commends.CONFIG, help="Get or set a repository option.")
+        parser_config.add_argument("name",
+                                   metavar="name",
+                                   help="option name, e.g. link_mode ({}).".format('/'.join(LINK_MODES)))
+        parser_config.add_argument("value",
+                                   metavar="value",
+                                   nargs="?",
+                                   help="new option value, print current value if missing.")
+        parser_config.set_defaults(func=config)
+
+    if command in (None, Commends.DIFF):
+        # create the parser for the "diff" command
+        parser_diff = subparsers.add_parser(
+            Commends.DIFF, help="Show changes between working directory, staging area and commits.")
+        parser_diff.add_argument("commits",
+                                 metavar="commit",
+                                 nargs="*",
+                                 help="commit ID or branch name, none for working directory vs staging, one for working directory vs commit, two for commit vs commit.")
+        parser_diff.add_argument("--staged",
+                                 action="store_true",
+                                 help="show staging area vs HEAD, or vs the given commit.")
+        parser_diff.set_defaults(func=diff)
+
+    if command in (None, Commends.GC, Commends.REPACK):
+        # create the parser for the "gc" command
+        parser_gc = subparsers.add_parser(
+            Commends.GC, aliases=[Commends.REPACK], help="Pack all objects into one compressed pack file.")
+        parser_gc.set_defaults(func=gc)
+
+    if command in (None, Commends.DAEMON):
+        # create the parser for the "daemon" command
+        parser_daemon = subparsers.add_parser(
+            Commends.DAEMON, help="Serve status of this repository from memory until stopped.")
+        parser_daemon.add_argument("--stop",
+                                   action="store_true",
+                                   help="stop the running daemon.")
+        parser_daemon.set_defaults(func=daemon)
+
+    if command in (None, Commends.LOG):
+        # create the parser for the "log" command
+        parser_log = subparsers.add_parser(
+            Commends.LOG, help="Show commit history, newest first. Paths to filter by follow a '--'.")
+        parser_log.add_argument("revisions",
+                                metavar="commit",
+                                nargs="*",
+                                help="commit ID or branch name to start from, HEAD if missing.")
+        parser_log.add_argument("-n", "--max-count",
+                                metavar="N",
+                                type=int,
+                                help="show at most N commits.")
+        parser_log.add_argument("--since",
+                                metavar="date",
+                                help="show commits newer than date, e.g. 2024-01-31 or '2024-01-31 12:00'.")
+        parser_log.add_argument("--oneline",
+                                action="store_true",
+                                help="show every commit on one line.")
+        parser_log.add_argument("--topo-order",
+                                action="store_true",
+                                help="never show a commit after its parents, instead of commit date order.")
+        parser_log.set_defaults(func=log)
+
+    if command in (None, Commends.SPARSE):
+        # create the parser for the "sparse" command
+        parser_sparse = subparsers.add_parser(
+            Commends.SPARSE, help="Check out only some paths of the repository, show them without arguments.")
+        parser_sparse.add_argument("paths",
+                                   metavar="path",
+                                   nargs="*",
+                                   help="file or folder to check out, may hold shell wildcards.")
+        parser_sparse.add_argument("--disable",
+                                   action="store_true",
+                                   help="check out every path again.")
+        parser_sparse.set_defaults(func=sparse)
+
+    if command in (None, Commends.BLAME):
+        # create the parser for the "blame" command
+        parser_blame = subparsers.add_parser(
+            Commends.BLAME, help="Show the commit which last changed every line of a file.")
+        parser_blame.add_argument("path",
+                                  metavar="path",
+                                  help="file to show.")
+        parser_blame.add_argument("commit",
+                                  metavar="commit",
+                                  nargs="?",
+                                  help="commit ID or branch name to show the file of, HEAD if missing.")
+        parser_blame.set_defaults(func=blame)
 
     if len(argv) == 0:
         parser.print_help()
         return
+    paths = []
+    if command in (Commends.LOG, Commends.CHECKOUT) and '--' in argv:
+        # argparse can't tell commits from paths, split them at '--' first
+        paths = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
     args = parser.parse_args(argv)
     if args.command == Commends.INIT:
         init(args.path)
     elif args.command == Commends.ADD:
-        add(args.path)
+        add(args.path, args.jobs)
     elif args.command == Commends.COMMIT:
-        commit(args.message)
+        commit(args.message, jobs=args.jobs)
     elif args.command == Commends.STATUS:
-        status()
+        status(args.jobs)
     elif args.command == Commends.RM:
         rm(args.path)
     elif args.command == Commends.CHECKOUT:
-        checkout(args.commit_id)
+        checkout(args.commit_id, args.jobs, paths)
     elif args.command == Commends.GRAPH:
-        graph(args.all)
+        graph(args.all, args.max_count, args.since, args.collapse, args.text)
     elif args.command == Commends.BRANCH:
         branch(args.name)
     elif args.command == Commends.MERGE:
         merge(args.name)
+    elif args.command == Commends.CONFIG:
+        config(args.name, args.value)
+    elif args.command == Commends.DIFF:
+        diff(args.commits, args.staged)
+    elif args.command in (Commends.GC, Commends.REPACK):
+        gc()
+    elif args.command == Commends.DAEMON:
+        daemon(args.stop)
+    elif args.command == Commends.LOG:
+        log(args.revisions, args.max_count, args.since, args.oneline, args.topo_order, paths)
+    elif args.command == Commends.SPARSE:
+        sparse(args.paths, args.disable)
+    elif args.command == Commends.BLAME:
+        blame(args.path, args.commit)
 
 
 def configure_logging():
-    file_handler = logging.FileHandler('error.log', 'a')
+    # error.log is opened on the first logged message only
+    file_handler = logging.FileHandler('error.log', 'a', delay=True)
     file_handler.setLevel(logging.DEBUG)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.WARNING)
@@ -746,10 +4249,41 @@ def check_dependencies():
             'Command "dot" was not found, visual graph will not be available.')
 
 
+def print_startup_profile(start, configured, done):
+    # process CPU time before main covers the interpreter start and wit.py module imports
+    lines = ['startup profile (ms):',
+             '  interpreter and module imports  {:8.2f}'.format(start * 1000)]
+    lines.extend('  import {:<25}{:8.2f}'.format(name, seconds * 1000)
+                 for name, seconds in LAZY_IMPORT_TIMES.items())
+    lines.append('  logging setup                   {:8.2f}'.format((configured - start) * 1000))
+    lines.append('  arguments and command           {:8.2f}'.format((done - configured) * 1000))
+    sys.stderr.write('\n'.join(lines) + '\n')
+
+
 def main(argv=sys.argv[1:]):
-    check_dependencies()
+    start = time.process_time()
+    # global options come before the command, so a message or path after it is never taken:
+    # --startup-profile, --trace or --trace=file. WIT_TRACE=file works for every wit call of a script
+    is_profiled = False
+    trace_file = os.environ.get('WIT_TRACE')
+    argv = list(argv)
+    while argv and (argv[0] in ('--startup-profile', '--trace') or argv[0].startswith('--trace=')):
+        arg = argv.pop(0)
+        if arg == '--startup-profile':
+            is_profiled = True
+        else:
+            trace_file = arg.partition('=')[2] or TRACE_FILE
+    if trace_file:
+        start_tracing()
     configure_logging()
-    parse_input(argv)
+    configured = time.process_time()
+    with trace_span('wit {}'.format(argv[0] if argv else '')):
+        parse_input(argv)
+    if is_profiled:
+        print_startup_profile(start, configured, time.process_time())
+    if trace_file:
+        TRACER.write(trace_file)
+        sys.stderr.write(TRACER.format_summary())
 
 
 if __name__ == '__main__':